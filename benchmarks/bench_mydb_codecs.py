@@ -0,0 +1,41 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from mydb import MyDB
+
+# Compares save time, load time and on-disk size of each MyDB codec for a
+# list of short strings.
+
+CONFIGS = [
+    ("legacy pickle", dict(format="pickle")),
+    ("pickle", dict(codec="pickle")),
+    ("pickle+zlib", dict(codec="pickle", compression="zlib")),
+    ("pickle+lzma", dict(codec="pickle", compression="lzma")),
+    ("utf8", dict(codec="utf8")),
+    ("utf8+zlib", dict(codec="utf8", compression="zlib")),
+    ("utf8+lzma", dict(codec="utf8", compression="lzma")),
+]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=200000)
+    args = parser.parse_args()
+    items = ["user-%d@example.com" % i for i in range(args.items)]
+    print("%-14s %10s %10s %12s" % ("codec", "save s", "load s", "bytes"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, options in CONFIGS:
+            fname = os.path.join(tmp, name.replace(" ", "_") + ".db")
+            db = MyDB(fname, **options)
+            start = time.perf_counter()
+            db.saveStrings(items)
+            saved = time.perf_counter()
+            assert len(MyDB(fname).loadStrings()) == len(items)
+            loaded = time.perf_counter()
+            print("%-14s %10.3f %10.3f %12d" % (name, saved - start, loaded - saved, os.path.getsize(fname)))
+
+if __name__ == '__main__':
+    main()
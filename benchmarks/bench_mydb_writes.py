@@ -0,0 +1,63 @@
+import argparse
+import os
+import pickle
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from mydb import MyDB
+
+# Compares append throughput of the original load-append-rewrite saveString
+# with the log-backed saveString, saveStrings_many, batch() and group commit.
+
+def rewrite_per_call(fname, items):
+    with open(fname, 'wb') as f:
+        pickle.dump([], f)
+    for item in items:
+        with open(fname, 'rb') as f:
+            arr = pickle.load(f)
+        arr.append(item)
+        with open(fname, 'wb') as f:
+            pickle.dump(arr, f)
+
+def save_string(fname, items):
+    db = MyDB(fname)
+    for item in items:
+        db.saveString(item)
+
+def save_strings_many(fname, items):
+    MyDB(fname).saveStrings_many(items)
+
+def batch(fname, items):
+    db = MyDB(fname)
+    with db.batch():
+        for item in items:
+            db.saveString(item)
+
+def group_commit(fname, items):
+    db = MyDB(fname, groupCommitItems=256, groupCommitSeconds=0.01)
+    for item in items:
+        db.saveString(item)
+    db.close()
+
+CASES = [rewrite_per_call, save_string, save_strings_many, batch, group_commit]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=5000)
+    args = parser.parse_args()
+    items = ["string number %d" % i for i in range(args.items)]
+    baseline = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for case in CASES:
+            fname = os.path.join(tmp, case.__name__ + ".db")
+            start = time.perf_counter()
+            case(fname, items)
+            elapsed = time.perf_counter() - start
+            rate = len(items) / elapsed
+            baseline = baseline or rate
+            print("%-18s %10.0f appends/s  %7.1fx" % (case.__name__, rate, rate / baseline))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from squirrel_db import DEFAULT_PROFILE, DURABILITY_PROFILES, SquirrelDB, connect
+
+# Compares inserting squirrels one at a time with inserting them in batches,
+# both directly through SquirrelDB and over HTTP (POST /squirrels vs
+# POST /squirrels/_bulk on one keep-alive connection), and reports rows/s.
+
+EMPTY_DB_PATH = os.path.join(os.path.dirname(__file__), "..", "empty_squirrel_db.db")
+SERVER_PATH = os.path.join(os.path.dirname(__file__), "..", "squirrel_server.py")
+
+def rows(count):
+    return [("Fluffy %d" % i, "large") for i in range(count)]
+
+def db_single(path, profile, count):
+    db = SquirrelDB(connect(path, profile))
+    for name, size in rows(count):
+        db.createSquirrel(name, size)
+    db.connection.close()
+
+def db_bulk(path, profile, count, batch):
+    db = SquirrelDB(connect(path, profile))
+    all_rows = rows(count)
+    for start in range(0, count, batch):
+        db.createSquirrels(all_rows[start:start + batch])
+    db.connection.close()
+
+def http_single(port, count):
+    conn = http.client.HTTPConnection("localhost", port)
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    for name, size in rows(count):
+        conn.request("POST", "/squirrels", body=urllib.parse.urlencode({"name": name, "size": size}), headers=headers)
+        conn.getresponse().read()
+    conn.close()
+
+def http_bulk(port, count, batch):
+    conn = http.client.HTTPConnection("localhost", port)
+    headers = {"Content-Type": "application/x-ndjson"}
+    all_rows = rows(count)
+    for start in range(0, count, batch):
+        body = "".join(json.dumps({"name": name, "size": size}) + "\n" for name, size in all_rows[start:start + batch])
+        conn.request("POST", "/squirrels/_bulk", body=body, headers=headers)
+        conn.getresponse().read()
+    conn.close()
+
+def timed(path, run):
+    shutil.copyfile(EMPTY_DB_PATH, path)
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+def start_server(path, port, profile):
+    server = subprocess.Popen([sys.executable, SERVER_PATH, "--port", str(port), "--db", path,
+                               "--mode", "threaded", "--durability", profile],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    while True:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+
+def timed_http(path, port, profile, run):
+    shutil.copyfile(EMPTY_DB_PATH, path)
+    server = start_server(path, port, profile)
+    try:
+        start = time.perf_counter()
+        run()
+        return time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2000, help="rows inserted by the one-at-a-time paths")
+    parser.add_argument("--bulk-rows", type=int, default=100000, help="rows inserted by the batched paths")
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--profile", choices=sorted(DURABILITY_PROFILES), default=DEFAULT_PROFILE)
+    args = parser.parse_args()
+    print("%-22s %10s %12s" % ("path", "rows", "rows/s"))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "squirrel_db.db")
+        cases = [
+            ("SquirrelDB single", args.rows,
+             lambda: timed(path, lambda: db_single(path, args.profile, args.rows))),
+            ("SquirrelDB bulk", args.bulk_rows,
+             lambda: timed(path, lambda: db_bulk(path, args.profile, args.bulk_rows, args.batch))),
+            ("HTTP POST /squirrels", args.rows,
+             lambda: timed_http(path, args.port, args.profile, lambda: http_single(args.port, args.rows))),
+            ("HTTP POST _bulk", args.bulk_rows,
+             lambda: timed_http(path, args.port, args.profile, lambda: http_bulk(args.port, args.bulk_rows, args.batch))),
+        ]
+        for name, count, run in cases:
+            seconds = run()
+            print("%-22s %10d %12.0f" % (name, count, count / seconds))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import squirrel_db
+from squirrel_db import SquirrelDB, connect
+
+# Times turning a full GET /squirrels listing into JSON text at several table
+# sizes: the original per-row dict_factory loop, the cached-column
+# dict_factory, plain tuples zipped into dicts, and getSquirrelsJSON.
+
+EMPTY_DB_PATH = os.path.join(os.path.dirname(__file__), "..", "empty_squirrel_db.db")
+
+def legacy_dict_factory(cursor, row):
+    # dict_factory as it was before column names were cached.
+    d = {}
+    for idx, col in enumerate(cursor.description):
+        d[col[0]] = row[idx]
+    return d
+
+def legacy_dicts(path):
+    connection = connect(path)
+    connection.row_factory = legacy_dict_factory
+    text = json.dumps(SquirrelDB(connection).getSquirrels())
+    connection.close()
+    return text
+
+def cached_dicts(path):
+    connection = connect(path)
+    text = json.dumps(SquirrelDB(connection).getSquirrels())
+    connection.close()
+    return text
+
+def zipped_tuples(path):
+    connection = connect(path, rowFactory="tuple")
+    cursor = connection.execute(*squirrel_db.listQuery())
+    columns = [column[0] for column in cursor.description]
+    text = json.dumps([dict(zip(columns, row)) for row in cursor.fetchall()])
+    connection.close()
+    return text
+
+def encoded(path):
+    connection = connect(path)
+    text, _, _ = SquirrelDB(connection).getSquirrelsJSON()
+    connection.close()
+    return text
+
+def fill(path, count):
+    shutil.copyfile(EMPTY_DB_PATH, path)
+    db = SquirrelDB(connect(path))
+    for start in range(0, count, 10000):
+        db.createSquirrels(("Fluffy %d" % i, "large") for i in range(start, min(start + 10000, count)))
+    db.connection.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=lambda text: [int(n) for n in text.split(",")], default=[10000, 100000, 1000000])
+    parser.add_argument("--repeats", type=int, default=3, help="best of this many runs is reported")
+    args = parser.parse_args()
+    cases = [
+        ("dict_factory (per-row loop)", legacy_dicts),
+        ("dict_factory (cached)", cached_dicts),
+        ("tuples + zip", zipped_tuples),
+        ("getSquirrelsJSON", encoded),
+    ]
+    print("sqlite %s, json_object %s" % (sqlite3.sqlite_version, "on" if squirrel_db.SQLITE_JSON else "off"))
+    print("%-30s %10s %10s %12s" % ("path", "rows", "seconds", "rows/s"))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "squirrel_db.db")
+        for size in args.sizes:
+            fill(path, size)
+            for name, run in cases:
+                best = None
+                for _ in range(args.repeats):
+                    start = time.perf_counter()
+                    run(path)
+                    seconds = time.perf_counter() - start
+                    best = seconds if best is None else min(best, seconds)
+                print("%-30s %10d %10.3f %12.0f" % (name, size, best, size / best))
+
+if __name__ == '__main__':
+    main()
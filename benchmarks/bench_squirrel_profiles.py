@@ -0,0 +1,64 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from squirrel_db import DURABILITY_PROFILES, SquirrelDB, connect
+
+# Runs concurrent readers and writers against one database file under each
+# durability profile and reports reads/s and writes/s.
+
+EMPTY_DB_PATH = os.path.join(os.path.dirname(__file__), "..", "empty_squirrel_db.db")
+
+def worker(path, profile, action, stop, counts, index):
+    db = SquirrelDB(connect(path, profile))
+    done = 0
+    while not stop.is_set():
+        if action == "write":
+            db.createSquirrel("Fluffy %d" % done, "large")
+        else:
+            db.getSquirrel(done % 100 + 1)
+        done += 1
+    counts[index] = done
+    db.connection.close()
+
+def run_profile(path, profile, readers, writers, seconds):
+    shutil.copyfile(EMPTY_DB_PATH, path)
+    seed = SquirrelDB(connect(path, profile))
+    for i in range(100):
+        seed.createSquirrel("Seed %d" % i, "small")
+    seed.connection.close()
+    stop = threading.Event()
+    actions = ["read"] * readers + ["write"] * writers
+    counts = [0] * len(actions)
+    threads = [threading.Thread(target=worker, args=(path, profile, action, stop, counts, i))
+               for i, action in enumerate(actions)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    reads = sum(c for c, a in zip(counts, actions) if a == "read")
+    writes = sum(c for c, a in zip(counts, actions) if a == "write")
+    return reads / seconds, writes / seconds
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    args = parser.parse_args()
+    print("%-10s %12s %12s" % ("profile", "reads/s", "writes/s"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for profile in DURABILITY_PROFILES:
+            reads, writes = run_profile(os.path.join(tmp, profile + ".db"), profile,
+                                        args.readers, args.writers, args.seconds)
+            print("%-10s %12.0f %12.0f" % (profile, reads, writes))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from mydb import MyDB
+
+# Load test for squirrel_server plus MyDB save/load microbenchmarks, reported
+# as JSON (throughput and p50/p95/p99 latency) and optionally compared with a
+# stored baseline:
+#
+#   python3 benchmarks/bench_suite.py --output run.json
+#   python3 benchmarks/bench_suite.py --baseline benchmarks/baseline.json
+#   python3 benchmarks/bench_suite.py --save-baseline benchmarks/baseline.json
+#
+# Runs offline: the server is started locally on a temporary copy of the empty
+# database. The exit status is 1 when a metric regressed past --tolerance, and
+# 2 when the baseline was recorded with a different workload (request mix and
+# counts, seed rows, server options or MyDB sizes), which is not compared.
+# A baseline is only meaningful on the machine that recorded it; the stored
+# benchmarks/baseline.json comes from a one-CPU Linux VM, so re-record it with
+# --save-baseline before comparing anywhere else.
+
+EMPTY_DB_PATH = os.path.join(os.path.dirname(__file__), "..", "empty_squirrel_db.db")
+SERVER_PATH = os.path.join(os.path.dirname(__file__), "..", "squirrel_server.py")
+DEFAULT_MIX = "list=10,retrieve=60,create=15,update=10,delete=5"
+# p99 over a few thousand requests on a shared box moves by tens of percent
+# from run to run, so it is reported but not compared unless asked for.
+DEFAULT_COMPARE = "throughput,items_per_s,p50_ms,p95_ms"
+FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        op, _, weight = part.partition("=")
+        if op not in ("list", "retrieve", "create", "update", "delete"):
+            raise argparse.ArgumentTypeError("unknown operation %r" % op)
+        mix[op] = float(weight)
+    return mix
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile of an already sorted list.
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def summarize(latencies, seconds):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "throughput": len(latencies) / seconds if seconds else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+# SERVER LOAD
+
+def start_server(path, port, server_args):
+    server = subprocess.Popen([sys.executable, SERVER_PATH, "--port", str(port), "--db", path,
+                               "--access-log", "off"] + server_args,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("squirrel_server did not start on port %d" % port)
+
+def seed(port, count):
+    conn = http.client.HTTPConnection("localhost", port)
+    for start in range(0, count, 1000):
+        body = json.dumps([{"name": "Seed %d" % i, "size": "large"} for i in range(start, min(start + 1000, count))])
+        conn.request("POST", "/squirrels/_bulk", body=body, headers={"Content-Type": "application/json"})
+        conn.getresponse().read()
+    conn.close()
+
+def client(port, mix, requests, rng, retrieve_ids, delete_ids, results, errors):
+    # Retrieves and updates hit the first half of the seeded ids; each
+    # client deletes its own stripe of the second half.
+    ops = list(mix)
+    weights = [mix[op] for op in ops]
+    conn = http.client.HTTPConnection("localhost", port)
+    for _ in range(requests):
+        op = rng.choices(ops, weights)[0]
+        if op == "list":
+            args = ("GET", "/squirrels?limit=50&after=%d" % rng.choice(retrieve_ids))
+        elif op == "retrieve":
+            args = ("GET", "/squirrels/%d" % rng.choice(retrieve_ids))
+        elif op == "create":
+            args = ("POST", "/squirrels", urllib.parse.urlencode({"name": "Bench", "size": "small"}), FORM_HEADERS)
+        elif op == "update":
+            args = ("PUT", "/squirrels/%d" % rng.choice(retrieve_ids),
+                    urllib.parse.urlencode({"name": "Bench", "size": "large"}), FORM_HEADERS)
+        else:
+            args = ("DELETE", "/squirrels/%d" % (delete_ids.pop() if delete_ids else 0))
+        start = time.perf_counter()
+        conn.request(*args)
+        response = conn.getresponse()
+        response.read()
+        results[op].append(time.perf_counter() - start)
+        if response.status >= 400 and not (op == "delete" and response.status == 404):
+            errors.append((op, response.status))
+    conn.close()
+
+def run_load(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "squirrel_db.db")
+        shutil.copyfile(EMPTY_DB_PATH, path)
+        server = start_server(path, args.port, args.server_arg)
+        try:
+            seed(args.port, args.seed_rows)
+            half = args.seed_rows // 2
+            retrieve_ids = list(range(1, half + 1))
+            all_results = []
+            errors = []
+            threads = []
+            for i in range(args.clients):
+                results = {op: [] for op in args.mix}
+                all_results.append(results)
+                delete_ids = list(range(half + 1 + i, args.seed_rows + 1, args.clients))
+                rng = random.Random(args.random_seed + i)
+                threads.append(threading.Thread(target=client, args=(
+                    args.port, args.mix, args.requests // args.clients, rng, retrieve_ids, delete_ids, results, errors)))
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            seconds = time.perf_counter() - start
+        finally:
+            server.terminate()
+            server.wait()
+    ops = {}
+    for op in args.mix:
+        ops[op] = summarize([l for results in all_results for l in results[op]], seconds)
+    total = summarize([l for results in all_results for op in results for l in results[op]], seconds)
+    total["errors"] = len(errors)
+    return {"total": total, "ops": ops}
+
+def median_report(reports):
+    # Median of each number across repeated runs of the same load.
+    first = reports[0]
+    if isinstance(first, dict):
+        return {key: median_report([report[key] for report in reports]) for key in first}
+    values = sorted(reports)
+    return values[len(values) // 2]
+
+# MYDB
+
+def run_mydb(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.mydb_sizes:
+            items = ["string number %d" % i for i in range(size)]
+            timings = {"saveStrings": [], "loadStrings": []}
+            # The first round only warms up caches and the allocator.
+            for repeat in range(args.mydb_repeats + 1):
+                db = MyDB(os.path.join(tmp, "bench_%d_%d.db" % (size, repeat)))
+                start = time.perf_counter()
+                db.saveStrings(items)
+                saved = time.perf_counter() - start
+                start = time.perf_counter()
+                db.loadStrings()
+                loaded = time.perf_counter() - start
+                db.close()
+                if repeat:
+                    timings["saveStrings"].append(saved)
+                    timings["loadStrings"].append(loaded)
+            for name, samples in timings.items():
+                summary = summarize(samples, sum(samples))
+                del summary["requests"], summary["throughput"]
+                summary["items_per_s"] = size / (summary["p50_ms"] / 1000)
+                results["%s/%d" % (name, size)] = summary
+    return results
+
+# BASELINE
+
+def flatten(report, prefix=""):
+    for key, value in report.items():
+        if isinstance(value, dict):
+            yield from flatten(value, prefix + key + ".")
+        else:
+            yield prefix + key, value
+
+# Meta fields that shape the workload: results are only comparable when these
+# match. Server fields are checked when the server ran, mydb fields when the
+# microbenchmarks did.
+SERVER_WORKLOAD = ("mix", "requests", "clients", "seed_rows", "server_args")
+MYDB_WORKLOAD = ("mydb_sizes", "mydb_repeats")
+
+def workload_mismatches(report, baseline):
+    keys = (SERVER_WORKLOAD if report["server"] else ()) + (MYDB_WORKLOAD if report["mydb"] else ())
+    meta, old = report["meta"], baseline.get("meta", {})
+    return [(key, old.get(key), meta[key]) for key in keys if old.get(key) != meta[key]]
+
+def compare(report, baseline, metrics, tolerance, min_delta_ms):
+    # Throughput-like metrics regress when they fall by more than tolerance,
+    # latencies when they rise by more than tolerance and min_delta_ms.
+    current = dict(flatten({"server": report["server"], "mydb": report["mydb"]}))
+    regressions = []
+    for name, old in flatten({"server": baseline.get("server", {}), "mydb": baseline.get("mydb", {})}):
+        new = current.get(name)
+        if new is None or not old or name.rpartition(".")[2] not in metrics:
+            continue
+        change = (new - old) / old
+        if name.endswith("_ms"):
+            regressed = change > tolerance and new - old > min_delta_ms
+        else:
+            regressed = change < -tolerance
+        if regressed:
+            regressions.append({"metric": name, "baseline": old, "current": new, "change": change})
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="squirrel_server load test and MyDB microbenchmarks")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help="weighted request mix (default %s)" % DEFAULT_MIX)
+    parser.add_argument("--requests", type=int, default=4000, help="requests across all clients")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--seed-rows", type=int, default=2000)
+    parser.add_argument("--random-seed", type=int, default=1)
+    parser.add_argument("--trials", type=int, default=3,
+                        help="load runs against a fresh server; the report holds their medians")
+    parser.add_argument("--port", type=int, default=8098)
+    parser.add_argument("--server-arg", action="append", default=None,
+                        help="extra squirrel_server option, e.g. --server-arg=--mode=threaded (repeatable)")
+    parser.add_argument("--mydb-sizes", type=lambda text: [int(n) for n in text.split(",")],
+                        default=[10000, 100000, 1000000])
+    parser.add_argument("--mydb-repeats", type=int, default=10)
+    parser.add_argument("--skip-server", action="store_true")
+    parser.add_argument("--skip-mydb", action="store_true")
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--save-baseline", help="write the JSON report here for later comparisons")
+    parser.add_argument("--compare", type=lambda text: text.split(","), default=DEFAULT_COMPARE.split(","),
+                        help="metrics checked against the baseline (default %s)" % DEFAULT_COMPARE)
+    parser.add_argument("--tolerance", type=float, default=0.3,
+                        help="relative change that counts as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=0.5,
+                        help="latency increases smaller than this are never regressions")
+    args = parser.parse_args()
+    if args.server_arg is None:
+        args.server_arg = ["--mode=threaded"]
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "mix": args.mix,
+            "requests": args.requests,
+            "clients": args.clients,
+            "trials": args.trials,
+            "seed_rows": args.seed_rows,
+            "server_args": args.server_arg,
+            "mydb_sizes": args.mydb_sizes,
+            "mydb_repeats": args.mydb_repeats,
+        },
+        "server": {} if args.skip_server else median_report([run_load(args) for _ in range(args.trials)]),
+        "mydb": {} if args.skip_mydb else run_mydb(args),
+    }
+    mismatches = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        mismatches = workload_mismatches(report, baseline)
+        if not mismatches:
+            report["regressions"] = compare(report, baseline, args.compare, args.tolerance, args.min_delta_ms)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print(text)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                f.write(text + "\n")
+    if report.get("regressions"):
+        for regression in report["regressions"]:
+            print("REGRESSION %(metric)s: %(baseline).4g -> %(current).4g (%(change)+.0f%%)" % dict(
+                regression, change=regression["change"] * 100), file=sys.stderr)
+        sys.exit(1)
+    if mismatches:
+        # Numbers from a different workload say nothing about regressions.
+        for key, old, new in mismatches:
+            print("NOT COMPARED: %s is %s here but %s in the baseline" % (
+                key, json.dumps(new), json.dumps(old)), file=sys.stderr)
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
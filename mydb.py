@@ -1,23 +1,747 @@
+import array
+import atexit
+import collections
+import contextlib
+import itertools
+import mmap
+import os
 import os.path
 import pickle
+import struct
+import sys
+import threading
+import weakref
+
+from mydb_codecs import CODECS, COMPRESSIONS, CompressingWriter, DecompressingReader, byId
+from mydb_search import SearchIndex
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The data file is either a single pickled list (the original format) or a
+# "records" file: a magic header followed by length-prefixed records, which can
+# be decoded one at a time without reading the rest of the file. The header
+# names the record codec and the compression applied to the body; version 1
+# files have no such fields and hold pickled, uncompressed records.
+PICKLE_FORMAT = "pickle"
+RECORDS_FORMAT = "records"
+RECORDS_MAGIC = b"MYDBREC2"
+RECORDS_MAGIC_V1 = b"MYDBREC1"
+CODEC_HEADER = struct.Struct("<BB")
+RECORD_HEADER = struct.Struct("<I")
+
+FileHeader = collections.namedtuple("FileHeader", "format codec compression")
+PICKLE_HEADER = FileHeader(PICKLE_FORMAT, CODECS["pickle"], COMPRESSIONS[None])
+
+# findPrefix/contains use a SearchIndex over the data file, kept in a
+# <file>.search sidecar, plus one over the log built in memory as new log
+# records show up. The sidecar holds the item count and the sorted keys, each
+# a position and a length-prefixed UTF-8 string, and is never unpickled, so
+# searching a utf8 store does not load pickles either.
+SEARCH_COUNT = struct.Struct("<Q")
+SEARCH_KEY = struct.Struct("<QI")
+
+# Records files get a sidecar index of fixed-width little-endian offsets, one
+# per record, so the i-th record is a single lookup into a memory map. The
+# index is memory-mapped as well, so opening it does not read it whole.
+INDEX_MAGIC = b"MYDBIDX1"
+
+# Appends go to a sidecar log next to the data file instead of rewriting it.
+# Both sidecars start with a header naming the data file they belong to
+# (size, mtime, inode) so one left over from an older data file is ignored.
+LOG_MAGIC = b"MYDBLOG1"
+SEARCH_MAGIC = b"MYDBSRC2"
+SIDECAR_HEADER = struct.Struct("<8sQQQ")
+
+# The log is folded back into the data file once it outgrows both this many
+# bytes and the data file itself, which keeps appends amortised O(1).
+COMPACT_MIN_BYTES = 1024 * 1024
+
+# Writers hold an exclusive flock on <file>.lock for the whole update; readers
+# hold it shared only while they open the data file and its log, so they get a
+# consistent pair and never hold up a writer for longer than a couple of opens.
+# Without fcntl (e.g. on Windows) locking is skipped.
+
+# Default budget for the shared read cache, measured in (estimated) bytes of
+# decoded strings held in memory.
+READ_CACHE_BYTES = 64 * 1024 * 1024
 
 class MyDB:
 
-    def __init__(self, filename):
+    def __init__(self, filename, compactMinBytes=COMPACT_MIN_BYTES, format=None,
+                 groupCommitItems=None, groupCommitSeconds=None, cache=False,
+                 codec=None, compression=None, searchIndex=False):
         self.fname = filename
-        if not os.path.isfile(self.fname):
-            self.saveStrings([])
+        self.logname = filename + ".log"
+        self.idxname = filename + ".idx"
+        self.lockname = filename + ".lock"
+        self.searchname = filename + ".search"
+        self.lockState = threading.local()
+        self.compactMinBytes = compactMinBytes
+        self.mappedRecords = None
+        self.logCache = None
+        # Guards logCache and searchLogCache, which threads sharing this
+        # instance extend in place. Separate from self.lock, which a batch
+        # holds while it waits for the exclusive file lock.
+        self.logLock = threading.Lock()
+        # searchIndex=True writes the search sidecar on every full save instead
+        # of on the first query after it.
+        self.searchIndexOnSave = searchIndex
+        self.searchCache = None
+        self.searchLogCache = None
+        # Group commit: appends are buffered and written (and fsynced) together
+        # once groupCommitItems are pending or groupCommitSeconds have passed.
+        self.groupCommitItems = groupCommitItems
+        self.groupCommitSeconds = groupCommitSeconds
+        self.groupCommit = groupCommitItems is not None or groupCommitSeconds is not None
+        if self.groupCommit:
+            GROUP_COMMITTED.add(self)
+        # Taken before the file lock wherever both are held.
+        self.lock = threading.RLock()
+        self.pending = []
+        self.batchDepth = 0
+        self.flushTimer = None
+        # cache=True shares READ_CACHE with other instances; a ReadCache can be
+        # passed to give this instance its own budget.
+        self.cache = READ_CACHE if cache is True else (cache or None)
+        self.cacheKey = os.path.abspath(filename)
+        # format, codec and compression only choose how the file is written
+        # from now on; reads always go by the header of the file on disk.
+        if format not in (None, PICKLE_FORMAT, RECORDS_FORMAT):
+            raise ValueError("unknown format %r" % format)
+        if codec is not None and codec not in CODECS:
+            raise ValueError("unknown codec %r" % codec)
+        if compression not in COMPRESSIONS:
+            raise ValueError("unknown compression %r" % compression)
+        if format == PICKLE_FORMAT and (codec not in (None, "pickle") or compression):
+            raise ValueError("the pickle format does not support codecs or compression")
+        with self.locked(exclusive=True):
+            exists = os.path.isfile(self.fname)
+            header = detectHeader(self.fname) if exists else PICKLE_HEADER
+            self.format = format or (RECORDS_FORMAT if codec or compression else header.format)
+            self.codec = CODECS[codec] if codec else header.codec
+            self.compression = COMPRESSIONS[compression] if compression else header.compression
+            if not exists:
+                self.saveStrings([])
 
     def loadStrings(self):
-        with open(self.fname, 'rb') as f:
-            arr = pickle.load(f)
-        return arr
+        if self.cache is None:
+            return list(self.iterStrings())
+        # The stamp is taken before reading, so a write that lands mid-read
+        # leaves a stale stamp behind and the next load misses.
+        stamp = self.cacheStamp()
+        arr = self.cache.get(self.cacheKey, stamp)
+        if arr is None:
+            arr = list(self.iterStrings())
+            self.cache.put(self.cacheKey, stamp, arr, decodedSize(arr))
+        return list(arr)
+
+    def cacheStamp(self):
+        with self.locked():
+            try:
+                logStamp = fileStamp(os.stat(self.logname))
+            except FileNotFoundError:
+                logStamp = None
+            return fileStamp(os.stat(self.fname)), logStamp
 
     def saveStrings(self, arr):
-        with open(self.fname, 'wb') as f:
-            pickle.dump(arr, f)
+        # Written to a temporary file and renamed over the original, so readers
+        # (and live memory maps) only ever see a complete data file. Appends
+        # still buffered were made before the rewrite, so they go out first
+        # and are replaced by it.
+        with self.lock, self.locked(exclusive=True):
+            self.writePending()
+            if self.searchIndexOnSave:
+                arr = list(arr)
+            offsets = None
+            with replacing(self.fname) as f:
+                if self.format != RECORDS_FORMAT:
+                    pickle.dump(arr, f, protocol=5)
+                elif self.compression.id:
+                    f.write(RECORDS_MAGIC + CODEC_HEADER.pack(self.codec.id, self.compression.id))
+                    writer = CompressingWriter(f, self.compression)
+                    writeRecords(writer, arr, self.codec)
+                    writer.close()
+                else:
+                    f.write(RECORDS_MAGIC + CODEC_HEADER.pack(self.codec.id, self.compression.id))
+                    offsets = writeRecords(f, arr, self.codec, f.tell())
+            if offsets is not None:
+                self.saveIndex(offsets)
+            else:
+                removeFile(self.idxname)
+            if self.searchIndexOnSave:
+                self.saveSearchIndex(SearchIndex.build(arr))
+            else:
+                removeFile(self.searchname)
+            removeFile(self.logname)
 
     def saveString(self, s):
-        arr = self.loadStrings()
-        arr.append(s)
-        self.saveStrings(arr)
+        with self.lock:
+            if self.batchDepth or self.groupCommit:
+                self.pending.append(s)
+                self.schedulePending()
+                return
+        self.appendRecords([s])
+
+    def checkpoint(self):
+        with self.lock, self.locked(exclusive=True):
+            self.writePending()
+            self.saveStrings(list(self.iterStrings()))
+
+    @contextlib.contextmanager
+    def locked(self, exclusive=False):
+        # Re-entrant per thread, so a checkpoint triggered by an append (or a
+        # read inside a checkpoint) reuses the lock already held.
+        if fcntl is None or getattr(self.lockState, 'held', False):
+            yield
+            return
+        with open(self.lockname, 'a+b') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self.lockState.held = True
+            try:
+                yield
+            finally:
+                self.lockState.held = False
+
+    # BATCHING
+
+    def saveStrings_many(self, items):
+        with self.lock:
+            if self.batchDepth or self.groupCommit:
+                self.pending.extend(items)
+                self.schedulePending()
+                return
+        self.appendRecords(list(items), sync=True)
+
+    @contextlib.contextmanager
+    def batch(self):
+        # Appends made inside the block are written with one write and one
+        # fsync when it exits, or discarded if it raises. The instance lock is
+        # held throughout, so other threads' appends wait for the batch.
+        with self.lock:
+            mark = len(self.pending)
+            self.batchDepth += 1
+            try:
+                yield self
+            except BaseException:
+                del self.pending[mark:]
+                raise
+            finally:
+                self.batchDepth -= 1
+            if not self.groupCommit:
+                self.flush()
+            else:
+                self.schedulePending()
+
+    def flush(self):
+        with self.lock:
+            if not self.batchDepth:
+                self.writePending()
+
+    def writePending(self):
+        # Inside a batch only from saveStrings/checkpoint, whose rewrite
+        # supersedes the batch's appends anyway.
+        with self.lock:
+            if self.flushTimer:
+                self.flushTimer.cancel()
+                self.flushTimer = None
+            items, self.pending = self.pending, []
+            if items:
+                self.appendRecords(items, sync=True)
+
+    def close(self):
+        self.flush()
+
+    def schedulePending(self):
+        if self.batchDepth or not self.pending:
+            return
+        if self.groupCommitItems is not None and len(self.pending) >= self.groupCommitItems:
+            self.flush()
+        elif self.groupCommitSeconds is not None and self.flushTimer is None:
+            self.flushTimer = threading.Timer(self.groupCommitSeconds, self.flush)
+            self.flushTimer.daemon = True
+            self.flushTimer.start()
+
+    # STREAMING
+
+    def iterStrings(self, start=0, stop=None):
+        if start < 0 or (stop is not None and stop < 0):
+            raise ValueError("iterStrings does not support negative indexes")
+        if stop is not None and stop <= start:
+            return
+        with self.locked():
+            base = open(self.fname, 'rb')
+            log = self.openLog(os.fstat(base.fileno()))
+        with base:
+            try:
+                header = readHeader(base)
+                records, skipped = bodyRecords(base, header, start)
+                records = itertools.chain(records, logRecords(log, start - skipped, header.codec))
+                yield from itertools.islice(records, None if stop is None else stop - start)
+            finally:
+                if log:
+                    log.close()
+
+    def count(self):
+        with self.locked():
+            mapped = self.mapped()
+            if mapped.offsets is None:
+                base = open(self.fname, 'rb')
+                log = self.openLog(os.fstat(base.fileno()))
+            else:
+                log, logOffsets = self.logIndex(mapped.stamp)
+        if mapped.offsets is not None:
+            if log:
+                log.close()
+            return len(mapped) + len(logOffsets)
+        with base:
+            header = readHeader(base)
+            if header.format == PICKLE_FORMAT:
+                total = len(pickle.load(base))
+            else:
+                total = sum(1 for _ in readPayloads(bodyReader(base, header)))
+        if log:
+            with log:
+                total += skipRecords(log)
+        return total
+
+    # RANDOM ACCESS
+
+    def __len__(self):
+        return self.count()
+
+    def getString(self, i, raw=False):
+        # With raw=True the encoded record is returned as a memoryview; for
+        # records in the data file it is a zero-copy slice of the memory map.
+        items = self.getStrings(i, i + 1 or None, raw)
+        if not items:
+            raise IndexError("MyDB index out of range")
+        return items[0]
+
+    def getStrings(self, i, j=None, raw=False):
+        with self.locked():
+            mapped = self.mapped()
+            if mapped.offsets is not None:
+                log, logOffsets = self.logIndex(mapped.stamp)
+        decode = mapped.header.codec.decode
+        if mapped.offsets is None:
+            start, stop, _ = slice(i, j).indices(self.count())
+            encode = mapped.header.codec.encode
+            return [memoryview(encode(s)) if raw else s for s in self.iterStrings(start, stop)]
+        try:
+            start, stop, _ = slice(i, j).indices(len(mapped) + len(logOffsets))
+            items = []
+            for n in range(start, stop):
+                if n < len(mapped):
+                    payload = mapped.payload(n)
+                else:
+                    payload = readPayload(log, logOffsets[n - len(mapped)])
+                items.append(payload if raw else decode(payload))
+            return items
+        finally:
+            if log:
+                log.close()
+
+    def mapped(self):
+        # Maps the data file and its offset index, remapping only when the data
+        # file has been replaced. Old maps are left to the garbage collector so
+        # memoryviews handed out earlier stay valid.
+        mapped = self.mappedRecords
+        if mapped is None or mapped.stamp != fileStamp(os.stat(self.fname)):
+            mapped = self.mappedRecords = MappedRecords.open(self)
+        return mapped
+
+    def saveIndex(self, offsets, stamp=None):
+        stamp = stamp or fileStamp(os.stat(self.fname))
+        packed = array.array('Q', offsets)
+        if sys.byteorder == 'big':
+            packed.byteswap()
+        with replacing(self.idxname) as f:
+            f.write(SIDECAR_HEADER.pack(INDEX_MAGIC, *stamp))
+            f.write(packed.tobytes())
+
+    # SEARCH
+
+    def findPrefix(self, prefix):
+        return self.search(lambda index: index.findPrefix(prefix))
+
+    def contains(self, sub):
+        return self.search(lambda index: index.contains(sub))
+
+    def search(self, query):
+        # Matches from the data file index and the log index, in storage order.
+        with self.locked():
+            mapped = self.mapped()
+            log, logOffsets = self.logIndex(mapped.stamp)
+        try:
+            index = self.searchIndex(mapped)
+            logIndex = self.searchLogIndex(log, logOffsets, mapped.header.codec)
+        finally:
+            if log:
+                log.close()
+        matches = sorted(query(index))
+        matches.extend(sorted((index.size + pos, s) for pos, s in query(logIndex)))
+        return [s for _, s in matches]
+
+    def searchIndex(self, mapped):
+        cache = self.searchCache
+        if cache is None or cache[0] != mapped.stamp:
+            index = loadSearchIndex(self.searchname, mapped.stamp)
+            if index is None:
+                with open(self.fname, 'rb') as f:
+                    if fileStamp(os.fstat(f.fileno())) != mapped.stamp:
+                        return self.searchIndex(self.mapped())
+                    header = readHeader(f)
+                    index = SearchIndex.build(bodyRecords(f, header, 0)[0])
+                try:
+                    self.saveSearchIndex(index, mapped.stamp)
+                except OSError:
+                    pass
+            cache = self.searchCache = (mapped.stamp, index)
+        return cache[1]
+
+    def searchLogIndex(self, log, logOffsets, codec):
+        # Keyed on the offsets list from logIndex, which is replaced whenever
+        # the log is, so the index resets along with it.
+        if log is None:
+            return SearchIndex()
+        with self.logLock:
+            cache = self.searchLogCache
+            if cache is None or cache[0] is not logOffsets:
+                cache = self.searchLogCache = (logOffsets, SearchIndex())
+            index = cache[1]
+            for offset in logOffsets[index.size:]:
+                index.add(codec.decode(readPayload(log, offset)))
+        return index
+
+    def saveSearchIndex(self, index, stamp=None):
+        stamp = stamp or fileStamp(os.stat(self.fname))
+        with replacing(self.searchname) as f:
+            f.write(SIDECAR_HEADER.pack(SEARCH_MAGIC, *stamp))
+            f.write(SEARCH_COUNT.pack(index.size))
+            for item, pos in index.keys:
+                data = item.encode('utf-8', 'surrogatepass')
+                f.write(SEARCH_KEY.pack(pos, len(data)) + data)
+
+    # LOG
+
+    def appendRecords(self, items, sync=False):
+        with self.lock, self.locked(exclusive=True):
+            # Only the header is read for the codec: mapping the data file
+            # would load (or rebuild) its whole offset index.
+            stamp = fileStamp(os.stat(self.fname))
+            mapped = self.mappedRecords
+            if mapped is not None and mapped.stamp == stamp:
+                codec = mapped.header.codec
+            else:
+                codec = detectHeader(self.fname).codec
+            with open(self.logname, 'a+b') as f:
+                f.seek(0)
+                if not hasSidecarHeader(f, LOG_MAGIC, stamp):
+                    f.truncate(0)
+                    f.write(SIDECAR_HEADER.pack(LOG_MAGIC, *stamp))
+                f.write(b"".join(encodeRecord(item, codec) for item in items))
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+                logSize = f.seek(0, os.SEEK_END)
+            if logSize > max(self.compactMinBytes, stamp[0]):
+                self.checkpoint()
+
+    def openLog(self, baseStat):
+        try:
+            f = open(self.logname, 'rb')
+        except FileNotFoundError:
+            return None
+        if not hasSidecarHeader(f, LOG_MAGIC, fileStamp(baseStat)):
+            f.close()
+            return None
+        return f
+
+    def logIndex(self, baseStamp):
+        # Offsets of the records in the log, extended incrementally as the log
+        # grows so repeated lookups do not rescan it from the start.
+        try:
+            f = open(self.logname, 'rb')
+        except FileNotFoundError:
+            return None, []
+        key = (baseStamp, os.fstat(f.fileno()).st_ino)
+        # The key, the position scanned up to and the offsets only ever
+        # change together, under logLock.
+        with self.logLock:
+            cache = self.logCache
+            if cache is None or cache[0] != key:
+                if not hasSidecarHeader(f, LOG_MAGIC, baseStamp):
+                    f.close()
+                    return None, []
+                cache = self.logCache = [key, SIDECAR_HEADER.size, []]
+            f.seek(cache[1])
+            cache[2].extend(scanRecords(f))
+            cache[1] = f.tell()
+            return f, cache[2]
+
+class ReadCache:
+
+    # Decoded contents of recently loaded files, keyed on path and validated
+    # against the (size, mtime, inode) of the data file and its log. Entries
+    # are evicted least recently used first once their decoded size (see
+    # decodedSize) exceeds maxBytes.
+
+    def __init__(self, maxBytes=READ_CACHE_BYTES):
+        self.maxBytes = maxBytes
+        self.totalBytes = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, stamp):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != stamp:
+                self.discard(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, stamp, value, cost):
+        with self.lock:
+            self.discard(key)
+            if cost > self.maxBytes:
+                return
+            self.entries[key] = (stamp, value, cost)
+            self.totalBytes += cost
+            while self.totalBytes > self.maxBytes:
+                self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.totalBytes -= entry[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.totalBytes = 0
+
+READ_CACHE = ReadCache()
+
+# Group-commit instances still holding buffered appends are flushed when the
+# interpreter exits. An instance that is garbage collected first, without
+# close(), loses whatever it was still buffering, so callers should close().
+GROUP_COMMITTED = weakref.WeakSet()
+
+@atexit.register
+def flushGroupCommits():
+    for db in list(GROUP_COMMITTED):
+        db.flush()
+
+class MappedRecords:
+
+    def __init__(self, stamp, header, data=None, offsets=None):
+        self.stamp = stamp
+        self.header = header
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def open(cls, db):
+        # offsets is None for pickle and compressed data files, which cannot
+        # be indexed.
+        with open(db.fname, 'rb') as f:
+            stamp = fileStamp(os.fstat(f.fileno()))
+            header = readHeader(f)
+            if header.format != RECORDS_FORMAT or header.compression.id:
+                return cls(stamp, header)
+            bodyStart = f.tell()
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offsets = loadIndex(db.idxname, stamp)
+        if offsets is None:
+            with open(db.fname, 'rb') as f:
+                f.seek(bodyStart)
+                offsets = list(scanRecords(f))
+            try:
+                db.saveIndex(offsets, stamp)
+            except OSError:
+                pass
+        return cls(stamp, header, data, offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def payload(self, i):
+        offset = self.offsets[i]
+        (length,) = RECORD_HEADER.unpack_from(self.data, offset)
+        start = offset + RECORD_HEADER.size
+        return memoryview(self.data)[start:start + length]
+
+def loadIndex(idxname, stamp):
+    try:
+        f = open(idxname, 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        if not hasSidecarHeader(f, INDEX_MAGIC, stamp):
+            return None
+        size = os.fstat(f.fileno()).st_size - SIDECAR_HEADER.size
+        # A truncated index is treated as missing and rebuilt.
+        if size % 8:
+            return None
+        if sys.byteorder == 'big':
+            offsets = array.array('Q')
+            offsets.frombytes(f.read())
+            offsets.byteswap()
+            return offsets
+        if not size:
+            return []
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(data)[SIDECAR_HEADER.size:].cast('Q')
+
+def loadSearchIndex(searchname, stamp):
+    try:
+        f = open(searchname, 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        if not hasSidecarHeader(f, SEARCH_MAGIC, stamp):
+            return None
+        data = f.read()
+    # A truncated sidecar is treated as missing and rebuilt.
+    if len(data) < SEARCH_COUNT.size:
+        return None
+    (size,) = SEARCH_COUNT.unpack_from(data)
+    offset = SEARCH_COUNT.size
+    keys = []
+    while offset < len(data):
+        if offset + SEARCH_KEY.size > len(data):
+            return None
+        pos, length = SEARCH_KEY.unpack_from(data, offset)
+        offset += SEARCH_KEY.size
+        if offset + length > len(data):
+            return None
+        keys.append((data[offset:offset + length].decode('utf-8', 'surrogatepass'), pos))
+        offset += length
+    return SearchIndex.fromKeys(size, keys)
+
+def decodedSize(arr):
+    # Memory held by a loaded list: the list itself plus each item, which for
+    # a compressed file can be many times its size on disk.
+    return sys.getsizeof(arr) + sum(map(sys.getsizeof, arr))
+
+def fileStamp(st):
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+def hasSidecarHeader(f, magic, stamp):
+    header = f.read(SIDECAR_HEADER.size)
+    return len(header) == SIDECAR_HEADER.size and SIDECAR_HEADER.unpack(header) == (magic, *stamp)
+
+@contextlib.contextmanager
+def replacing(fname):
+    tmpname = "%s.%d.%d.tmp" % (fname, os.getpid(), threading.get_ident())
+    try:
+        with open(tmpname, 'wb') as f:
+            yield f
+        os.replace(tmpname, fname)
+    except BaseException:
+        removeFile(tmpname)
+        raise
+
+def removeFile(fname):
+    try:
+        os.remove(fname)
+    except FileNotFoundError:
+        pass
+
+def detectHeader(fname):
+    with open(fname, 'rb') as f:
+        return readHeader(f)
+
+def readHeader(f):
+    # Leaves f positioned at the first record (records) or at the start (pickle).
+    magic = f.read(len(RECORDS_MAGIC))
+    if magic == RECORDS_MAGIC:
+        codecId, compressionId = CODEC_HEADER.unpack(f.read(CODEC_HEADER.size))
+        return FileHeader(RECORDS_FORMAT, byId(CODECS, codecId), byId(COMPRESSIONS, compressionId))
+    if magic == RECORDS_MAGIC_V1:
+        return FileHeader(RECORDS_FORMAT, CODECS["pickle"], COMPRESSIONS[None])
+    f.seek(0)
+    return PICKLE_HEADER
+
+def bodyReader(f, header):
+    return DecompressingReader(f, header.compression) if header.compression.id else f
+
+def bodyRecords(f, header, skip):
+    # Returns an iterator over the data file from index `skip` and the number
+    # of records actually skipped. Pickle files have to be decoded in one go.
+    if header.format == PICKLE_FORMAT:
+        arr = pickle.load(f)
+        return iter(arr[skip:]), min(skip, len(arr))
+    if header.compression.id:
+        reader = bodyReader(f, header)
+        skipped = sum(1 for _ in itertools.islice(readPayloads(reader), skip))
+        return readRecords(reader, header.codec), skipped
+    skipped = skipRecords(f, skip)
+    return readRecords(f, header.codec), skipped
+
+def logRecords(f, skip, codec):
+    if f is None:
+        return
+    skipRecords(f, skip)
+    yield from readRecords(f, codec)
+
+def encodeRecord(item, codec):
+    payload = codec.encode(item)
+    return RECORD_HEADER.pack(len(payload)) + payload
+
+def writeRecords(f, items, codec, offset=0):
+    # Returns the offset of each record, counting from `offset`.
+    offsets = []
+    for item in items:
+        record = encodeRecord(item, codec)
+        offsets.append(offset)
+        f.write(record)
+        offset += len(record)
+    return offsets
+
+def readPayloads(f):
+    # A short read at the end means an append was cut off mid-write; the
+    # records before it are intact and the partial one is dropped.
+    while True:
+        prefix = f.read(RECORD_HEADER.size)
+        if len(prefix) < RECORD_HEADER.size:
+            return
+        (length,) = RECORD_HEADER.unpack(prefix)
+        payload = f.read(length)
+        if len(payload) < length:
+            return
+        yield payload
+
+def readRecords(f, codec):
+    return map(codec.decode, readPayloads(f))
+
+def readPayload(f, offset):
+    f.seek(offset)
+    (length,) = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+    return memoryview(f.read(length))
+
+def scanRecords(f):
+    # Yields the offset of each complete record without decoding payloads.
+    size = os.fstat(f.fileno()).st_size
+    offset = f.tell()
+    while True:
+        prefix = f.read(RECORD_HEADER.size)
+        if len(prefix) < RECORD_HEADER.size:
+            break
+        (length,) = RECORD_HEADER.unpack(prefix)
+        end = offset + RECORD_HEADER.size + length
+        if end > size:
+            break
+        f.seek(end)
+        yield offset
+        offset = end
+    f.seek(offset)
+
+def skipRecords(f, limit=None):
+    return sum(1 for _ in itertools.islice(scanRecords(f), limit))
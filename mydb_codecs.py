@@ -0,0 +1,85 @@
+import collections
+import lzma
+import pickle
+import zlib
+
+# Record codecs turn one stored item into the payload of a length-prefixed
+# record and back. The id is what gets written into the data file header.
+Codec = collections.namedtuple("Codec", "name id encode decode")
+
+def encodeUtf8(item):
+    if not isinstance(item, str):
+        raise TypeError("the utf8 codec only stores str, not %s" % type(item).__name__)
+    return item.encode("utf-8")
+
+def decodeUtf8(payload):
+    return str(payload, "utf-8")
+
+def encodePickle(item):
+    return pickle.dumps(item, protocol=5)
+
+CODECS = {
+    "pickle": Codec("pickle", 0, encodePickle, pickle.loads),
+    "utf8": Codec("utf8", 1, encodeUtf8, decodeUtf8),
+}
+
+# Compression applies to the whole body of a records file as one stream, so
+# short strings still compress well. Compressed files can be streamed but not
+# memory-mapped or indexed.
+Compression = collections.namedtuple("Compression", "name id compressor decompressor")
+
+COMPRESSIONS = {
+    None: Compression(None, 0, None, None),
+    "zlib": Compression("zlib", 1, lambda: zlib.compressobj(6), zlib.decompressobj),
+    "lzma": Compression("lzma", 2, lzma.LZMACompressor, lzma.LZMADecompressor),
+}
+
+def byId(table, id):
+    for entry in table.values():
+        if entry.id == id:
+            return entry
+    raise ValueError("unknown %s id %d in MyDB header" % (
+        "codec" if table is CODECS else "compression", id))
+
+class CompressingWriter:
+
+    # File-like wrapper that compresses everything written through it.
+
+    def __init__(self, f, compression):
+        self.f = f
+        self.compressor = compression.compressor()
+
+    def write(self, data):
+        self.f.write(self.compressor.compress(data))
+
+    def close(self):
+        self.f.write(self.compressor.flush())
+
+class DecompressingReader:
+
+    # File-like wrapper with read(n) over a compressed stream, decompressing
+    # only as much of the underlying file as the caller asks for.
+
+    def __init__(self, f, compression, chunkSize=64 * 1024):
+        self.f = f
+        self.decompressor = compression.decompressor()
+        self.chunkSize = chunkSize
+        self.buffer = bytearray()
+        self.pos = 0
+        self.eof = False
+
+    def read(self, n):
+        while len(self.buffer) - self.pos < n and not self.eof:
+            if self.pos:
+                del self.buffer[:self.pos]
+                self.pos = 0
+            chunk = self.f.read(self.chunkSize)
+            if chunk:
+                self.buffer += self.decompressor.decompress(chunk)
+            else:
+                self.eof = True
+                if hasattr(self.decompressor, "flush"):
+                    self.buffer += self.decompressor.flush()
+        data = bytes(self.buffer[self.pos:self.pos + n])
+        self.pos += len(data)
+        return data
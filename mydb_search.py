@@ -0,0 +1,72 @@
+import bisect
+import collections
+
+class SearchIndex:
+
+    # Sorted keys for prefix lookups and a trigram posting list for substring
+    # lookups over the str items of a MyDB store. Items are identified by
+    # their position; non-str items are counted but not indexed.
+
+    def __init__(self):
+        self.size = 0
+        self.strings = {}
+        self.keys = []
+        self.trigrams = collections.defaultdict(list)
+
+    @classmethod
+    def build(cls, items):
+        index = cls()
+        for item in items:
+            index.add(item, sort=False)
+        index.keys.sort()
+        return index
+
+    @classmethod
+    def fromKeys(cls, size, keys):
+        # Rebuilds an index from its sorted (string, position) keys; the
+        # trigram postings are derived from them again.
+        index = cls()
+        index.size = size
+        index.keys = keys
+        for item, pos in keys:
+            index.strings[pos] = item
+            for gram in set(trigrams(item)):
+                index.trigrams[gram].append(pos)
+        return index
+
+    def add(self, item, sort=True):
+        pos = self.size
+        self.size += 1
+        if not isinstance(item, str):
+            return
+        self.strings[pos] = item
+        if sort:
+            bisect.insort(self.keys, (item, pos))
+        else:
+            self.keys.append((item, pos))
+        for gram in set(trigrams(item)):
+            self.trigrams[gram].append(pos)
+
+    def findPrefix(self, prefix):
+        matches = []
+        i = bisect.bisect_left(self.keys, (prefix,))
+        while i < len(self.keys) and self.keys[i][0].startswith(prefix):
+            matches.append((self.keys[i][1], self.keys[i][0]))
+            i += 1
+        return matches
+
+    def contains(self, sub):
+        grams = set(trigrams(sub))
+        if not grams:
+            # Too short to have a trigram: every string is a candidate.
+            return [(pos, s) for pos, s in self.strings.items() if sub in s]
+        postings = sorted((self.trigrams.get(gram, ()) for gram in grams), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                break
+        return [(pos, self.strings[pos]) for pos in candidates if sub in self.strings[pos]]
+
+def trigrams(s):
+    return (s[i:i + 3] for i in range(len(s) - 2))
@@ -0,0 +1,146 @@
+import collections
+import threading
+import time
+
+DEFAULT_CACHE_BYTES = 16 * 1024 * 1024
+DEFAULT_CACHE_TTL = 30
+
+class ResponseCache:
+
+    # LRU of serialized GET responses, bounded by total bytes and with a TTL.
+    # Values are (body, headers) pairs. Keys are (kind, resource, encoding),
+    # so each content encoding of a response is its own entry. Listings and
+    # single squirrels are kept apart so a write drops exactly the entries it
+    # can have changed: every listing, plus every encoding of the squirrel it
+    # touched.
+    #
+    # A response built from data read before an invalidation must not be
+    # stored after it, so callers start each request with validate(), which
+    # also applies the watcher, and pass the generation it returns to put();
+    # put() ignores values from an older generation.
+
+    def __init__(self, maxBytes=DEFAULT_CACHE_BYTES, ttl=DEFAULT_CACHE_TTL, watcher=None, clock=time.monotonic):
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.watcher = watcher
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.listings = set()
+        self.squirrels = collections.defaultdict(set)
+        self.bytes = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def validate(self):
+        with self.lock:
+            if self.watcher and self.watcher.changed():
+                self.clearLocked()
+            return self.generation
+
+    def get(self, key, countMiss=True):
+        # countMiss=False is for a probe that falls back to another key on a
+        # miss, so a request counts as one hit or one miss.
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += countMiss
+                return None
+            expires, size, value = entry
+            if expires <= self.clock():
+                self.removeLocked(key)
+                self.misses += countMiss
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation):
+        size = entrySize(value)
+        if size > self.maxBytes:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            if key in self.entries:
+                self.removeLocked(key)
+            self.entries[key] = (self.clock() + self.ttl, size, value)
+            self.bytes += size
+            if key[0] == "squirrels":
+                self.listings.add(key)
+            else:
+                self.squirrels[key[1]].add(key)
+            while self.bytes > self.maxBytes:
+                self.removeLocked(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, squirrelId=None):
+        # Called after a write commits; squirrelId is None for a create.
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            for key in list(self.listings):
+                self.removeLocked(key)
+            key = squirrelKey(squirrelId)
+            if key:
+                for variant in list(self.squirrels.get(key[1], ())):
+                    self.removeLocked(variant)
+
+    def clear(self):
+        with self.lock:
+            self.clearLocked()
+
+    def clearLocked(self):
+        self.generation += 1
+        self.invalidations += 1
+        self.entries.clear()
+        self.listings.clear()
+        self.squirrels.clear()
+        self.bytes = 0
+
+    def removeLocked(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+        if key[0] == "squirrels":
+            self.listings.discard(key)
+            return
+        variants = self.squirrels[key[1]]
+        variants.discard(key)
+        if not variants:
+            del self.squirrels[key[1]]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def close(self):
+        if self.watcher:
+            self.watcher.close()
+
+def squirrelKey(squirrelId, encoding=None):
+    # "7" and "007" name the same row, so single squirrels are keyed by the
+    # integer id. Only plain ASCII digits are keyed: int() also accepts
+    # spellings such as "1_0", which SQLite does not match against id 10, so
+    # "+10", " 10" and anything else that is not all digits is never cached.
+    if isinstance(squirrelId, str) and squirrelId.isascii() and squirrelId.isdigit():
+        return ("squirrel", int(squirrelId), encoding)
+    if isinstance(squirrelId, int) and not isinstance(squirrelId, bool):
+        return ("squirrel", squirrelId, encoding)
+    return None
+
+def listingKey(query, encoding=None):
+    return ("squirrels", query, encoding)
+
+def entrySize(value):
+    body, headers = value
+    return len(body) + sum(len(name) + len(headerValue) for name, headerValue in headers)
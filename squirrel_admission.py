@@ -0,0 +1,82 @@
+import collections
+import threading
+import time
+
+class AdmissionControl:
+
+    # Caps the requests being served at once at maxInFlight. Beyond that up to
+    # maxQueue requests wait for a slot, each until its deadline; anything
+    # else is turned away at once, so under overload the server answers fast
+    # rather than letting every request's latency grow.
+
+    def __init__(self, maxInFlight, maxQueue=64, clock=time.perf_counter):
+        self.maxInFlight = maxInFlight
+        self.maxQueue = maxQueue
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.inFlight = 0
+        self.waiting = 0
+
+    def admit(self, deadline):
+        # True if the caller got a slot, which it must hand back with
+        # release(); False if the queue is full or the deadline passed. A
+        # request already past its deadline (it sat in the listen backlog or
+        # the worker queue) is turned away even if a slot is free: its client
+        # has waited too long already, and serving it would keep the ones
+        # behind it waiting too.
+        with self.condition:
+            if self.clock() >= deadline:
+                return False
+            if self.inFlight < self.maxInFlight:
+                self.inFlight += 1
+                return True
+            if self.waiting >= self.maxQueue:
+                return False
+            self.waiting += 1
+            try:
+                while self.inFlight >= self.maxInFlight:
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                self.inFlight += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self.condition:
+            self.inFlight -= 1
+            self.condition.notify()
+
+class RateLimiter:
+
+    # A token bucket per client: each holds up to `burst` tokens and refills
+    # at `rate` per second, and every request takes one. Only the maxClients
+    # most recently seen clients are remembered; a forgotten one starts again
+    # with a full bucket.
+
+    def __init__(self, rate, burst, maxClients=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.maxClients = maxClients
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.buckets = collections.OrderedDict()
+
+    def acquire(self, client):
+        # Returns 0 if the request may go ahead, otherwise the seconds until
+        # the client's next token.
+        now = self.clock()
+        with self.lock:
+            tokens, updated = self.buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self.buckets[client] = (tokens, now)
+            if len(self.buckets) > self.maxClients:
+                self.buckets.popitem(last=False)
+            return wait
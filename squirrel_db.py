@@ -1,41 +1,559 @@
+import contextlib
+import functools
+import json
+import os
+import queue
 import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from urllib.request import pathname2url
+from squirrel_schema import migrate
+
+DB_PATH = "squirrel_db.db"
+
+# PRAGMAs applied to every new connection. "safe" is SQLite's stock rollback
+# journal with a full fsync per commit; "balanced" switches to WAL so readers
+# no longer wait for writers and only fsyncs at checkpoints; "fast" also stops
+# fsyncing altogether, so a power loss can drop recent commits (but not
+# corrupt the file).
+DURABILITY_PROFILES = {
+    "safe": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "cache_size": -2000,
+        "mmap_size": 0,
+        "busy_timeout": 5000,
+    },
+    "balanced": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -16000,
+        "mmap_size": 64 * 1024 * 1024,
+        "busy_timeout": 5000,
+    },
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "cache_size": -64000,
+        "mmap_size": 256 * 1024 * 1024,
+        "busy_timeout": 10000,
+    },
+}
+DEFAULT_PROFILE = "safe"
+
+WRITE_ACK_MODES = ("commit", "enqueue")
+
+SQUIRREL_FIELDS = ("id", "name", "size")
+
+# Prepared statements kept per connection. listQuery builds one statement per
+# combination of filters, LIMIT and projection (a few hundred in all), more
+# than sqlite3's default of 128.
+STATEMENT_CACHE_SIZE = 512
+
+# json_object() is built into SQLite from 3.38 on; before that it depends on
+# how the library was compiled, so getSquirrelsJSON encodes in Python instead.
+SQLITE_JSON = sqlite3.sqlite_version_info >= (3, 38, 0)
+
+# (description, column names) of the last result dict_factory saw. A cursor
+# hands every row of a result the same description object, so the names are
+# only worked out once per query.
+lastColumns = (None, ())
 
 def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+    global lastColumns
+    description, names = lastColumns
+    if description is not cursor.description:
+        names = tuple(column[0] for column in cursor.description)
+        lastColumns = (cursor.description, names)
+    return dict(zip(names, row))
+
+# What connect(rowFactory=...) makes a connection's rows: dicts, sqlite3.Row
+# (indexable by position and by column name) or plain tuples.
+ROW_FACTORIES = {
+    "dict": dict_factory,
+    "row": sqlite3.Row,
+    "tuple": None,
+}
+
+def connect(path=DB_PATH, profile=DEFAULT_PROFILE, rowFactory="dict", readOnly=False):
+    # A readOnly connection opens the file with mode=ro and query_only, so it
+    # can never write, and leaves the schema and journal mode to the writer.
+    if profile not in DURABILITY_PROFILES:
+        raise ValueError("unknown durability profile %r" % profile)
+    if rowFactory not in ROW_FACTORIES:
+        raise ValueError("unknown row factory %r" % rowFactory)
+    if readOnly:
+        uri = "file:%s?mode=ro" % pathname2url(os.path.abspath(path))
+        connection = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    else:
+        connection = sqlite3.connect(path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma, value in DURABILITY_PROFILES[profile].items():
+        if readOnly and pragma == "journal_mode":
+            continue
+        connection.execute("PRAGMA %s = %s" % (pragma, value)).fetchall()
+    connection.row_factory = ROW_FACTORIES[rowFactory]
+    if readOnly:
+        connection.execute("PRAGMA query_only = ON")
+    else:
+        migrate(connection)
+    return connection
+
+def timed(method):
+    # Reports how long each call took to the SquirrelDB's metrics, if any.
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.metrics is None:
+            return method(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.metrics.observeQuery(name, time.perf_counter() - start)
+    return wrapper
 
 class SquirrelDB:
 
-    def __init__(self):
-        self.connection = sqlite3.connect("squirrel_db.db")
-        self.connection.row_factory = dict_factory
+    def __init__(self, connection=None, cache=None, metrics=None, writer=None):
+        self.connection = connection or connect()
         self.cursor = self.connection.cursor()
+        self.cache = cache
+        self.metrics = metrics
+        self.writer = writer
 
-    def getSquirrels(self):
-        self.cursor.execute("SELECT * FROM squirrels ORDER BY id")
+    @timed
+    def getSquirrels(self, **options):
+        self.cursor.execute(*listQuery(**options))
         return self.cursor.fetchall()
 
+    @timed
+    def getSquirrelsJSON(self, **options):
+        # The listing as JSON text, built from plain tuples without a dict per
+        # row. Returns (text, row count, last id), the id being there for
+        # paging even when the projection leaves it out.
+        cursor = self.tupleCursor()
+        cursor.execute(*listQuery(encoded=True, **options))
+        rows = encodeRows(cursor.fetchall(), options.get("fields"))
+        return "[" + ",".join([row[0] for row in rows]) + "]", len(rows), rows[-1][1] if rows else None
+
+    def iterSquirrels(self, batchSize=500, encoded=False, **options):
+        # Yields the listing in lists of up to batchSize rows, so only one
+        # batch is held in memory at a time. With encoded=True each row is a
+        # (json text, id) pair, as in getSquirrelsJSON.
+        start = time.perf_counter()
+        cursor = self.tupleCursor() if encoded else self.connection.cursor()
+        cursor.execute(*listQuery(encoded=encoded, **options))
+        while True:
+            rows = cursor.fetchmany(batchSize)
+            if encoded:
+                rows = encodeRows(rows, options.get("fields"))
+            if self.metrics is not None:
+                # Timed per batch, leaving out the caller's work in between.
+                self.metrics.observeQuery("iterSquirrels", time.perf_counter() - start)
+            if not rows:
+                return
+            yield rows
+            start = time.perf_counter()
+
+    @timed
     def getSquirrel(self, squirrelId):
         data = [squirrelId]
         self.cursor.execute("SELECT * FROM squirrels WHERE id = ?", data)
         return self.cursor.fetchone()
 
+    @timed
     def createSquirrel(self, name, size):
+        if self.writer is not None:
+            self.writer.write("create", None, name, size)
+            return None
         data = [name, size]
         self.cursor.execute("INSERT INTO squirrels (name, size) VALUES (?, ?)", data)
         self.connection.commit()
+        self.invalidate()
         return None
 
+    @timed
     def updateSquirrel(self, squirrelId, name, size):
+        # Through a WriteQueue in "commit" mode, returns the batch's (status,
+        # id), so a row deleted before the batch ran shows up as a 404.
+        if self.writer is not None:
+            return self.writer.write("update", squirrelId, name, size)
         data = [name, size, squirrelId]
         self.cursor.execute("UPDATE squirrels SET name = ?, size = ? WHERE id = ?", data)
         self.connection.commit()
+        self.invalidate(squirrelId)
         return None
 
+    @timed
     def deleteSquirrel(self, squirrelId):
+        # Returns the (status, id) of a queued delete, as updateSquirrel does.
+        if self.writer is not None:
+            return self.writer.write("delete", squirrelId)
         data = [squirrelId]
         self.cursor.execute("DELETE FROM squirrels WHERE id = ?", data)
         self.connection.commit()
+        self.invalidate(squirrelId)
         return None
+
+    @timed
+    def createSquirrels(self, rows):
+        # One transaction and one commit for the whole batch; returns the new ids.
+        try:
+            ids = self.insertSquirrels(rows)
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+        self.invalidate()
+        return ids
+
+    @timed
+    def applySquirrels(self, operations):
+        # Runs a batch of ("create", None, name, size), ("update", id, name,
+        # size) and ("delete", id, None, None) operations in one transaction
+        # and returns one (status, id) result per operation: 201 with the new
+        # id, 204, or 404 for an id that does not exist. Runs of consecutive
+        # creates go through executemany. Callers pass the row's integer id,
+        # which is what the response cache is invalidated by.
+        results = []
+        creates = []
+        touched = []
+        try:
+            for op, squirrelId, name, size in operations:
+                if op == "create":
+                    creates.append((name, size))
+                    continue
+                if creates:
+                    results.extend((201, newId) for newId in self.insertSquirrels(creates))
+                    creates = []
+                if op == "update":
+                    self.cursor.execute("UPDATE squirrels SET name = ?, size = ? WHERE id = ?", [name, size, squirrelId])
+                elif op == "delete":
+                    self.cursor.execute("DELETE FROM squirrels WHERE id = ?", [squirrelId])
+                else:
+                    raise ValueError("unknown bulk operation %r" % op)
+                if self.cursor.rowcount:
+                    touched.append(squirrelId)
+                    results.append((204, squirrelId))
+                else:
+                    results.append((404, squirrelId))
+            if creates:
+                results.extend((201, newId) for newId in self.insertSquirrels(creates))
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+        self.invalidate()
+        for squirrelId in touched:
+            self.invalidate(squirrelId)
+        return results
+
+    def insertSquirrels(self, rows):
+        # Inserts without committing. Inside the transaction nothing else can
+        # insert, and an INTEGER PRIMARY KEY hands out max(id) + 1, so the
+        # batch got the ids ending at last_insert_rowid().
+        rows = list(rows)
+        if not rows:
+            return []
+        self.cursor.executemany("INSERT INTO squirrels (name, size) VALUES (?, ?)", rows)
+        last = self.tupleCursor().execute("SELECT last_insert_rowid()").fetchone()[0]
+        return list(range(last - len(rows) + 1, last + 1))
+
+    def tupleCursor(self):
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        return cursor
+
+    def invalidate(self, squirrelId=None):
+        if self.cache is not None:
+            self.cache.invalidate(squirrelId)
+
+def encodeRows(rows, fields=None):
+    # Turns rows selected by listQuery(encoded=True) into (json text, id).
+    if SQLITE_JSON:
+        return rows
+    fields = fields or SQUIRREL_FIELDS
+    return [(json.dumps(dict(zip(fields, row))), row[-1]) for row in rows]
+
+def listQuery(after=None, limit=None, fields=None, name=None, size=None, encoded=False):
+    # Keyset pagination: pass the last id of the previous page as `after`.
+    # encoded=True selects (json_object text, id) for encodeRows instead,
+    # or the fields and id for it to encode in Python.
+    if fields:
+        for field in fields:
+            if field not in SQUIRREL_FIELDS:
+                raise ValueError("unknown squirrel field %r" % field)
+    conditions = []
+    data = []
+    if after is not None:
+        conditions.append("id > ?")
+        data.append(after)
+    if name is not None:
+        conditions.append("name = ?")
+        data.append(name)
+    if size is not None:
+        conditions.append("size = ?")
+        data.append(size)
+    if encoded and SQLITE_JSON:
+        pairs = ["'%s', %s" % (field, field) for field in dict.fromkeys(fields or SQUIRREL_FIELDS)]
+        columns = "json_object(%s), id" % ", ".join(pairs)
+    elif encoded:
+        columns = ", ".join(list(fields or SQUIRREL_FIELDS) + ["id"])
+    else:
+        columns = ", ".join(fields) if fields else "*"
+    sql = "SELECT %s FROM squirrels" % columns
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY id"
+    if limit is not None:
+        sql += " LIMIT ?"
+        data.append(limit)
+    return sql, data
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+
+    # Keeps up to `size` connections to the database file open and lends each
+    # to one thread at a time. Checkout discards a connection that fails a
+    # trivial query or whose file has been replaced or deleted since it was
+    # opened, so swapping the database file underneath the server is safe.
+
+    def __init__(self, path=DB_PATH, size=5, timeout=30, profile=DEFAULT_PROFILE, cache=None, metrics=None,
+                 writer=None, rowFactory="dict", readOnly=False):
+        self.path = path
+        self.rowFactory = rowFactory
+        self.readOnly = readOnly
+        self.cache = cache
+        self.metrics = metrics
+        self.writer = writer
+        self.profile = profile
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.local = threading.local()
+        self.closed = False
+
+    @contextlib.contextmanager
+    def connection(self):
+        # Re-entrant per thread: a nested borrow reuses the outer connection.
+        held = getattr(self.local, "held", None)
+        if held:
+            yield held[0]
+            return
+        entry = self.checkout()
+        self.local.held = entry
+        ok = False
+        try:
+            yield entry[0]
+            ok = True
+        finally:
+            self.local.held = None
+            self.checkin(entry, discard=not ok)
+
+    @contextlib.contextmanager
+    def squirrelDB(self):
+        with self.connection() as connection:
+            yield SquirrelDB(connection, self.cache, self.metrics, self.writer)
+
+    def checkout(self):
+        if self.closed:
+            raise PoolTimeout("connection pool is closed")
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolTimeout("no database connection free after %ss" % self.timeout)
+        try:
+            while True:
+                try:
+                    entry = self.idle.get_nowait()
+                except queue.Empty:
+                    return self.open()
+                if self.healthy(entry):
+                    return entry
+                entry[0].close()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def checkin(self, entry, discard=False):
+        connection = entry[0]
+        try:
+            if discard or self.closed:
+                connection.close()
+            else:
+                if connection.in_transaction:
+                    connection.rollback()
+                self.idle.put(entry)
+        finally:
+            self.slots.release()
+
+    def open(self):
+        connection = connect(self.path, self.profile, self.rowFactory, self.readOnly)
+        return connection, fileIdentity(self.path)
+
+    def healthy(self, entry):
+        connection, identity = entry
+        if identity is None or fileIdentity(self.path) != identity:
+            return False
+        try:
+            connection.execute("SELECT 1").fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                connection, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            connection.close()
+
+def fileIdentity(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_dev, st.st_ino
+
+class WriteQueue:
+
+    # Write-behind for createSquirrel, updateSquirrel and deleteSquirrel: a
+    # single writer thread with its own connection takes queued mutations and
+    # commits them together through applySquirrels, once maxItems are waiting
+    # or maxDelay seconds after the first one arrived, whichever comes first.
+    # With ack "commit" a caller returns once its batch has committed; with
+    # "enqueue" it returns at once, so it may not see its own write yet and
+    # its errors are only reported on stderr.
+
+    def __init__(self, path=DB_PATH, profile=DEFAULT_PROFILE, cache=None, metrics=None,
+                 maxItems=500, maxDelay=0.002, ack="commit"):
+        if ack not in WRITE_ACK_MODES:
+            raise ValueError("unknown write ack mode %r" % ack)
+        self.path = path
+        self.profile = profile
+        self.cache = cache
+        self.metrics = metrics
+        self.maxItems = maxItems
+        self.maxDelay = maxDelay
+        self.ack = ack
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.connection = connect(path, profile)
+        self.thread = threading.Thread(target=self.run, name="squirrel-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, op, squirrelId=None, name=None, size=None):
+        # Returns a Future that resolves to applySquirrels' (status, id).
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("write queue is closed")
+            self.queue.put(((op, squirrelId, name, size), future))
+        return future
+
+    def write(self, op, squirrelId=None, name=None, size=None):
+        future = self.submit(op, squirrelId, name, size)
+        if self.ack == "commit":
+            return future.result()
+        return None
+
+    def run(self):
+        db = SquirrelDB(self.connection, self.cache, self.metrics)
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.maxDelay
+            while len(batch) < self.maxItems:
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    break
+                batch.append(item)
+            self.apply(db, batch)
+            if item is None:
+                break
+        self.connection.close()
+
+    def apply(self, db, batch):
+        operations = [operation for operation, _ in batch]
+        try:
+            results = db.applySquirrels(operations)
+        except Exception:
+            # The batch was rolled back; retry one at a time so a single bad
+            # operation fails alone.
+            results = []
+            for operation in operations:
+                try:
+                    results.append(db.applySquirrels([operation])[0])
+                except Exception as e:
+                    results.append(e)
+        for (operation, future), result in zip(batch, results):
+            if not isinstance(result, Exception):
+                future.set_result(result)
+                continue
+            future.set_exception(result)
+            if self.ack == "enqueue":
+                print("Write-behind %s of squirrel %s failed: %r" % (operation[0], operation[1], result),
+                      file=sys.stderr)
+
+    def close(self):
+        # Commits whatever is still queued before returning.
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(None)
+        self.thread.join()
+
+class DataVersionWatcher:
+
+    # Tells a ResponseCache when the database has changed behind its back:
+    # PRAGMA data_version on a private, never-writing connection moves
+    # whenever any other connection commits, including ones in other
+    # processes, and the file identity check catches the file being replaced.
+
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+        self.identity = None
+        self.version = None
+
+    def changed(self):
+        with self.lock:
+            identity = fileIdentity(self.path)
+            if self.connection is None or identity != self.identity:
+                self.reopen(identity)
+                return True
+            version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+            if version != self.version:
+                self.version = version
+                return True
+            return False
+
+    def reopen(self, identity):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        self.identity = identity
+        if identity is not None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
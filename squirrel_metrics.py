@@ -0,0 +1,163 @@
+import bisect
+import collections
+import random
+import sys
+import threading
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+
+    # Prometheus-style histogram; counts are kept per bucket and only made
+    # cumulative when rendered.
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels, lines):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append("%s_bucket%s %d" % (name, formatLabels(labels + (("le", formatBound(bound)),)), cumulative))
+        lines.append("%s_sum%s %r" % (name, formatLabels(labels), self.sum))
+        lines.append("%s_count%s %d" % (name, formatLabels(labels), self.count))
+
+class Metrics:
+
+    # Request and query counters for one server process, rendered in the
+    # Prometheus text exposition format by render(). Under --mode prefork
+    # every worker keeps its own.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inFlight = 0
+        self.requests = collections.Counter()
+        self.responseBytes = collections.Counter()
+        self.latency = collections.defaultdict(Histogram)
+        self.queries = collections.defaultdict(Histogram)
+
+    def requestStarted(self):
+        with self.lock:
+            self.inFlight += 1
+
+    def requestFinished(self, route, method, status, seconds, written):
+        with self.lock:
+            self.inFlight -= 1
+            self.requests[route, method, status] += 1
+            self.responseBytes[route] += written
+            self.latency[route].observe(seconds)
+
+    def observeQuery(self, method, seconds):
+        with self.lock:
+            self.queries[method].observe(seconds)
+
+    def render(self, cacheStats=None):
+        lines = []
+        with self.lock:
+            lines.append("# HELP squirrel_http_requests_in_flight Requests currently being served.")
+            lines.append("# TYPE squirrel_http_requests_in_flight gauge")
+            lines.append("squirrel_http_requests_in_flight %d" % self.inFlight)
+            lines.append("# HELP squirrel_http_requests_total Requests served, by route, method and status.")
+            lines.append("# TYPE squirrel_http_requests_total counter")
+            for (route, method, status), count in sorted(self.requests.items()):
+                labels = (("route", route), ("method", method), ("status", status))
+                lines.append("squirrel_http_requests_total%s %d" % (formatLabels(labels), count))
+            lines.append("# HELP squirrel_http_request_duration_seconds Time from request line to response.")
+            lines.append("# TYPE squirrel_http_request_duration_seconds histogram")
+            for route, histogram in sorted(self.latency.items()):
+                histogram.render("squirrel_http_request_duration_seconds", (("route", route),), lines)
+            lines.append("# HELP squirrel_http_response_bytes_total Bytes written, headers included.")
+            lines.append("# TYPE squirrel_http_response_bytes_total counter")
+            for route, written in sorted(self.responseBytes.items()):
+                lines.append("squirrel_http_response_bytes_total%s %d" % (formatLabels((("route", route),)), written))
+            lines.append("# HELP squirrel_db_query_duration_seconds Time spent in each SquirrelDB method.")
+            lines.append("# TYPE squirrel_db_query_duration_seconds histogram")
+            for method, histogram in sorted(self.queries.items()):
+                histogram.render("squirrel_db_query_duration_seconds", (("method", method),), lines)
+        if cacheStats is not None:
+            for name in ("hits", "misses", "evictions", "invalidations"):
+                lines.append("# TYPE squirrel_response_cache_%s_total counter" % name)
+                lines.append("squirrel_response_cache_%s_total %d" % (name, cacheStats[name]))
+            for name in ("entries", "bytes"):
+                lines.append("# TYPE squirrel_response_cache_%s gauge" % name)
+                lines.append("squirrel_response_cache_%s %d" % (name, cacheStats[name]))
+        return "\n".join(lines) + "\n"
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, escapeLabel(str(value))) for name, value in labels)
+
+def escapeLabel(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def formatBound(bound):
+    return bound if isinstance(bound, str) else repr(float(bound))
+
+class AccessLog:
+
+    # Where the handler's per-request log lines go. "stderr" writes each line
+    # as it comes, like BaseHTTPRequestHandler; "buffered" collects them and
+    # writes from a background thread every flushInterval seconds or once
+    # bufferBytes have piled up; "off" drops them. sampleRate < 1 keeps only
+    # that fraction of request lines.
+
+    def __init__(self, mode="stderr", sampleRate=1.0, stream=None, flushInterval=1.0, bufferBytes=64 * 1024):
+        self.mode = mode
+        self.sampleRate = sampleRate
+        self.stream = stream or sys.stderr
+        self.flushInterval = flushInterval
+        self.bufferBytes = bufferBytes
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffered = 0
+        self.stopped = threading.Event()
+        self.flusher = None
+        if mode == "buffered":
+            self.flusher = threading.Thread(target=self.flushPeriodically, name="squirrel-access-log", daemon=True)
+            self.flusher.start()
+
+    def sample(self):
+        if self.mode == "off":
+            return False
+        return self.sampleRate >= 1 or random.random() < self.sampleRate
+
+    def write(self, line):
+        if self.mode == "off":
+            return
+        if self.mode != "buffered":
+            self.stream.write(line)
+            return
+        with self.lock:
+            self.buffer.append(line)
+            self.buffered += len(line)
+            full = self.buffered >= self.bufferBytes
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            lines = self.buffer
+            self.buffer = []
+            self.buffered = 0
+        if lines:
+            self.stream.write("".join(lines))
+            self.stream.flush()
+
+    def flushPeriodically(self):
+        while not self.stopped.wait(self.flushInterval):
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        if self.flusher:
+            self.flusher.join()
+        self.flush()
@@ -0,0 +1,92 @@
+import sqlite3
+import threading
+
+# Each migration brings the schema from the version before it (its position
+# in the list) to the next one; PRAGMA user_version records how many have been
+# applied to a database file. Only ever append: a database that has applied a
+# migration never runs it again.
+MIGRATIONS = [
+    # 1: the table, for files that were not copied from empty_squirrel_db.db.
+    [
+        "CREATE TABLE IF NOT EXISTS squirrels (id INTEGER PRIMARY KEY, name TEXT, size TEXT)",
+    ],
+    # 2: (name, id) and (size, id) let a filtered listing walk the index in id
+    # order, so keyset pages stay cheap however far into the table they start.
+    [
+        "CREATE INDEX IF NOT EXISTS squirrels_name_id ON squirrels (name, id)",
+        "CREATE INDEX IF NOT EXISTS squirrels_size_id ON squirrels (size, id)",
+    ],
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Rows ANALYZE samples per index, so that it takes about as long on a table of
+# millions of rows as on one of thousands.
+ANALYSIS_LIMIT = 1000
+
+class SchemaError(Exception):
+    pass
+
+def schemaVersion(connection):
+    cursor = connection.cursor()
+    cursor.row_factory = None
+    return cursor.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(connection):
+    # Applies whatever migrations the database has not seen yet and returns
+    # the schema version. Safe to run from several connections or processes
+    # at once: the version is checked again under the write lock.
+    version = schemaVersion(connection)
+    if version == SCHEMA_VERSION:
+        return version
+    if version > SCHEMA_VERSION:
+        raise SchemaError("database schema version %d is newer than this code's %d" % (version, SCHEMA_VERSION))
+    if connection.in_transaction:
+        connection.commit()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        version = schemaVersion(connection)
+        for statements in MIGRATIONS[version:]:
+            for statement in statements:
+                connection.execute(statement)
+        version = max(version, SCHEMA_VERSION)
+        connection.execute("PRAGMA user_version = %d" % version)
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    return version
+
+def optimize(connection):
+    # Refreshes the statistics the query planner uses to choose between the
+    # indexes; sampled, so its cost does not grow with the table.
+    connection.execute("PRAGMA analysis_limit = %d" % ANALYSIS_LIMIT).fetchall()
+    connection.execute("ANALYZE")
+    connection.execute("PRAGMA optimize")
+    connection.commit()
+
+class Optimizer:
+
+    # Runs optimize() on its own connection every `interval` seconds from a
+    # background thread, until close().
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="squirrel-optimize", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            connection = sqlite3.connect(self.path)
+            try:
+                optimize(connection)
+            except sqlite3.Error:
+                # Busy or replaced underneath us; the next round tries again.
+                pass
+            finally:
+                connection.close()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
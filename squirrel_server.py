@@ -1,10 +1,47 @@
+import argparse
+import asyncio
+import io
 import json
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import parse_qs
-from squirrel_db import SquirrelDB
+import math
+import os
+import signal
+import sys
+import time
+import traceback
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+from response_cache import DEFAULT_CACHE_BYTES, DEFAULT_CACHE_TTL, ResponseCache, listingKey, squirrelKey
+from squirrel_db import DB_PATH, DEFAULT_PROFILE, DURABILITY_PROFILES, SQUIRREL_FIELDS, WRITE_ACK_MODES
+from squirrel_db import ConnectionPool, DataVersionWatcher, WriteQueue, connect
+from squirrel_admission import AdmissionControl, RateLimiter
+from squirrel_metrics import AccessLog, Metrics
+from squirrel_schema import Optimizer, optimize
+
+MAX_PAGE_SIZE = 1000
+MAX_BULK_ITEMS = 10000
+
+# How much of a rejected request's body is read and dropped before the
+# connection is closed, and for how long. Closing with unread data resets the
+# connection, so a client still sending its body would never see the 429/503.
+MAX_DRAIN_BYTES = 16 * 1024 * 1024
+MAX_DRAIN_SECONDS = 2
+
+# zlib window bits for each Content-Encoding we offer: gzip framing, and
+# zlib framing for "deflate" (RFC 9110 section 8.4.1.2).
+ENCODING_WBITS = {"gzip": 31, "deflate": 15}
 
 class SquirrelServerHandler(BaseHTTPRequestHandler):
 
+    # HTTP/1.1 with a Content-Length on every response, so clients can send
+    # further requests on the same connection. See keepAlive() for when the
+    # server closes it anyway.
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; with Nagle on, the body
+    # of a kept-alive response waits for the client's delayed ACK.
+    disable_nagle_algorithm = True
+
     # HTTP METHODS
 
     def do_GET(self):
@@ -14,13 +51,17 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
                 self.handleSquirrelsRetrieve(resourceId)
             else:
                 self.handleSquirrelsIndex()
+        elif resourceName == "_metrics" and not resourceId:
+            self.handleMetrics()
         else:
             self.handle404()
 
     def do_POST(self):
         resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
-            if resourceId:
+            if resourceId == "_bulk":
+                self.handleSquirrelsBulk()
+            elif resourceId:
                 self.handle404()
             else:
                 self.handleSquirrelsCreate()
@@ -47,19 +88,237 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
         else:
             self.handle404()
 
+    # CONNECTION
+
+    def setup(self):
+        self.timeout = self.server.settings.keep_alive_timeout
+        # When the connection was accepted, if the server kept track; see admit().
+        self.arrived = getattr(self.server, "arrivals", {}).pop(self.request, None)
+        super().setup()
+
+    def handle_one_request(self):
+        # Each request that gets as far as its request line is counted in the
+        # server's Metrics, timed from then until the response is written.
+        self.requestCount = getattr(self, "requestCount", 0) + 1
+        # parse_request leaves path unset (or as the previous request's) when
+        # the request line is malformed; such requests count as route "other".
+        self.path = None
+        self.cacheStatus = None
+        self.requestStart = None
+        self.statusCode = None
+        self.admitted = False
+        if not isinstance(self.wfile, CountingWriter):
+            self.wfile = CountingWriter(self.wfile)
+        written = self.wfile.written
+        try:
+            super().handle_one_request()
+        finally:
+            if self.admitted:
+                self.server.admission.release()
+            if self.requestStart is not None:
+                self.server.metrics.requestFinished(
+                    routeOf(self.path), self.command or "-", self.statusCode or "error",
+                    time.perf_counter() - self.requestStart, self.wfile.written - written)
+
+    def parse_request(self):
+        # Reads the whole body up front: a response that ignores it (a 404
+        # for a POST, say) must not leave it to be parsed as the next request.
+        self.requestStart = time.perf_counter()
+        self.server.metrics.requestStarted()
+        if not super().parse_request():
+            return False
+        if not self.admit():
+            return False
+        self.body = b""
+        if self.headers.get("Transfer-Encoding"):
+            self.close_connection = True
+            return True
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_error(400, "Bad Content-Length")
+            return False
+        if length:
+            self.body = self.rfile.read(length)
+        return True
+
+    def admit(self):
+        # Turns the request away with 429 if its client is over --rate-limit,
+        # or with 503 if --max-in-flight requests are being served and no slot
+        # frees up by its deadline, --queue-timeout after it arrived. Either
+        # way the body is drained (see drainBody) and the connection closed.
+        # /_metrics is always served, so the server can be watched while it
+        # sheds load.
+        server = self.server
+        if routeOf(self.path) == "/_metrics":
+            return True
+        if server.rateLimiter is not None:
+            wait = server.rateLimiter.acquire(self.client_address[0])
+            if wait:
+                self.reject(429, wait)
+                return False
+        if server.admission is not None:
+            arrived = self.arrived if self.arrived is not None else self.requestStart
+            self.arrived = None
+            if not server.admission.admit(arrived + server.settings.queue_timeout):
+                self.reject(503, server.settings.retry_after)
+                return False
+            self.admitted = True
+        return True
+
+    def reject(self, status, retryAfter):
+        message = "%d %s" % (status, self.responses[status][0])
+        headers = [("Retry-After", str(math.ceil(retryAfter))), ("Connection", "close")]
+        self.respond(status, bytes(message, "utf-8"), "text/plain", headers)
+        self.drainBody()
+
+    def drainBody(self):
+        # Reads and drops up to MAX_DRAIN_BYTES of the declared body within
+        # MAX_DRAIN_SECONDS; a larger or slower body is cut off. The asyncio
+        # engine has read the body already, so there rfile is just a buffer.
+        try:
+            remaining = min(int(self.headers.get("Content-Length", 0)), MAX_DRAIN_BYTES)
+        except ValueError:
+            return
+        deadline = time.monotonic() + MAX_DRAIN_SECONDS
+        connection = getattr(self, "connection", None)
+        try:
+            while remaining > 0:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                if connection is not None:
+                    connection.settimeout(timeout)
+                chunk = self.rfile.read1(min(remaining, 64 * 1024))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+        except OSError:
+            pass
+
+    def keepAlive(self):
+        # The single-threaded server cannot serve anyone else while it waits
+        # on an idle connection, so it closes after every response.
+        settings = self.server.settings
+        return settings.mode != "single" and self.requestCount < settings.keep_alive_requests
+
+    def end_headers(self):
+        if not self.close_connection and not self.keepAlive():
+            self.send_header("Connection", "close")
+        super().end_headers()
+
+    def send_response(self, code, message=None):
+        self.statusCode = code
+        super().send_response(code, message)
+
+    # LOGGING
+
+    def log_request(self, code="-", size="-"):
+        if self.server.accessLog.sample():
+            super().log_request(code, size)
+
+    def log_error(self, format, *args):
+        # Errors always go straight to stderr, whatever --access-log says.
+        super().log_message(format, *args)
+
+    def log_message(self, format, *args):
+        self.server.accessLog.write("%s - - [%s] %s\n" % (
+            self.address_string(), self.log_date_time_string(), format % args))
+
     # HELPERS
 
+    def readDatabase(self):
+        return self.server.readers.squirrelDB()
+
+    def writeDatabase(self, bulk=False):
+        # Writes go through the one writer connection. With --write-behind,
+        # single-row writes only borrow a reader for their lookups: the write
+        # queue's own connection does the writing.
+        if self.server.readers.writer is not None and not bulk:
+            return self.readDatabase()
+        return self.server.pool.squirrelDB()
+
+    def cached(self, keyFor, build):
+        # Read-through lookup in the server's ResponseCache. keyFor(encoding)
+        # gives the cache key of each content encoding of the response, or
+        # None if it must not be cached; build() returns the uncompressed
+        # (body, headers), or None for nothing to send. Returns (body,
+        # headers, encoding), with the body already compressed as negotiated.
+        encoding = self.acceptedEncoding()
+        cache = self.server.pool.cache
+        if cache is None or keyFor(None) is None:
+            value = build()
+            return value and self.encode(value, encoding)
+        generation = cache.validate()
+        if encoding:
+            value = cache.get(keyFor(encoding), countMiss=False)
+            if value is not None:
+                self.cacheStatus = "HIT"
+                return value + (encoding,)
+        value = cache.get(keyFor(None))
+        self.cacheStatus = "HIT" if value is not None else "MISS"
+        if value is None:
+            value = build()
+            if value is None:
+                return None
+            cache.put(keyFor(None), value, generation)
+        body, headers, encoding = self.encode(value, encoding)
+        if encoding:
+            cache.put(keyFor(encoding), (body, headers), generation)
+        return body, headers, encoding
+
+    def acceptedEncoding(self):
+        settings = self.server.settings
+        if settings.compress_level <= 0:
+            return None
+        return negotiateEncoding(self.headers.get("Accept-Encoding"))
+
+    def compressible(self, body):
+        settings = self.server.settings
+        return settings.compress_level > 0 and len(body) >= settings.compress_min_bytes
+
+    def encode(self, value, encoding):
+        body, headers = value
+        if encoding and self.compressible(body):
+            return compressBody(body, encoding, self.server.settings.compress_level), headers, encoding
+        return body, headers, None
+
+    def respond(self, status, body=b"", contentType=None, headers=(), encoding=None):
+        # Compresses the body as negotiated unless the caller passes the
+        # encoding it is already compressed with.
+        if encoding is None:
+            body, headers, encoding = self.encode((body, headers), self.acceptedEncoding())
+        self.send_response(status)
+        if contentType:
+            self.send_header("Content-Type", contentType)
+        for name, value in headers:
+            self.send_header(name, value)
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        if encoding or self.compressible(body):
+            self.send_header("Vary", "Accept-Encoding")
+        cacheStatus = getattr(self, "cacheStatus", None)
+        if cacheStatus:
+            self.send_header("X-Cache", cacheStatus)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
     def getRequestData(self):
-        length = int(self.headers["Content-Length"])
-        body = self.rfile.read(length).decode("utf-8")
+        body = self.body.decode("utf-8")
         data = parse_qs(body)
         for key in data:
             data[key] = data[key][0]
         return data
 
     def parsePath(self):
-        if self.path.startswith("/"):
-            parts = self.path[1:].split("/")
+        url = urlsplit(self.path)
+        self.query = parse_qs(url.query)
+        if url.path.startswith("/"):
+            parts = url.path[1:].split("/")
             resourceName = parts[0]
             resourceId = None
             if len(parts) > 1:
@@ -67,67 +326,658 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
             return (resourceName, resourceId)
         return False
 
+    def getListOptions(self):
+        # ?after=<id>&limit=N pages by id, ?fields=a,b projects columns and
+        # ?name=/?size= filter; raises ValueError on anything malformed.
+        query = {key: values[-1] for key, values in self.query.items()}
+        options = {}
+        if "after" in query:
+            options["after"] = int(query["after"])
+        if "limit" in query:
+            options["limit"] = int(query["limit"])
+            if options["limit"] < 1:
+                raise ValueError("limit must be positive")
+            options["limit"] = min(options["limit"], MAX_PAGE_SIZE)
+        if "fields" in query:
+            options["fields"] = [field for field in query["fields"].split(",") if field]
+            for field in options["fields"]:
+                if field not in SQUIRREL_FIELDS:
+                    raise ValueError("unknown field %r" % field)
+        for key in ("name", "size"):
+            if key in query:
+                options[key] = query[key]
+        return options
+
+    def wantsStream(self, options):
+        # Only unbounded listings are streamed; ?stream=0/1 overrides the
+        # server's --stream-listings default.
+        if "limit" in options:
+            return False
+        stream = self.query.get("stream", [None])[-1]
+        if stream is None:
+            return self.server.settings.stream_listings
+        return stream.lower() not in ("0", "false", "no")
+
+    def startStream(self, status, contentType):
+        # HTTP/1.1 clients get a chunked body; HTTP/1.0 clients get a body
+        # that ends when the connection closes. A negotiated encoding is
+        # applied as the body is written, flushed after every write so each
+        # batch reaches the client as soon as it is encoded.
+        self.chunked = self.request_version not in ("HTTP/0.9", "HTTP/1.0")
+        encoding = self.acceptedEncoding()
+        self.compressor = None
+        if encoding:
+            self.compressor = zlib.compressobj(self.server.settings.compress_level, zlib.DEFLATED, ENCODING_WBITS[encoding])
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        if self.server.settings.compress_level > 0:
+            self.send_header("Vary", "Accept-Encoding")
+        if self.chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Connection", "close")
+        self.end_headers()
+
+    def writeStream(self, data, flushMode=zlib.Z_SYNC_FLUSH):
+        if self.compressor:
+            data = self.compressor.compress(data) + self.compressor.flush(flushMode)
+        if not data:
+            return
+        if self.chunked:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+    def endStream(self):
+        if self.compressor:
+            self.writeStream(b"", zlib.Z_FINISH)
+        if self.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+    def getBulkOperations(self):
+        # The body is a JSON array or, with Content-Type application/x-ndjson,
+        # one JSON object per line. Each item is {"name", "size"} to create,
+        # {"op": "update", "id", "name", "size"} or {"op": "delete", "id"}.
+        # Returns (operations, errors): malformed items get an error entry at
+        # their position instead of an operation. Raises ValueError if the
+        # body itself cannot be parsed.
+        body = self.body.decode("utf-8")
+        if self.headers.get("Content-Type", "").startswith("application/x-ndjson"):
+            items = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            items = json.loads(body)
+            if not isinstance(items, list):
+                raise ValueError("expected a JSON array of squirrels")
+        if len(items) > MAX_BULK_ITEMS:
+            raise ValueError("at most %d items per request" % MAX_BULK_ITEMS)
+        operations = []
+        errors = {}
+        for position, item in enumerate(items):
+            try:
+                operations.append(bulkOperation(item))
+            except ValueError as e:
+                errors[position] = str(e)
+        return operations, errors
+
+    def nextPageLink(self, lastId):
+        query = {key: values[-1] for key, values in self.query.items()}
+        query["after"] = lastId
+        return "</squirrels?%s>; rel=\"next\"" % urlencode(query)
+
     # ACTIONS
 
     def handleSquirrelsIndex(self):
-        db = SquirrelDB()
-        squirrelsList = db.getSquirrels()
-        self.send_response(200)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        self.wfile.write(bytes(json.dumps(squirrelsList), "utf-8"))
+        try:
+            options = self.getListOptions()
+        except ValueError as e:
+            self.handle400(str(e))
+            return
+        if self.wantsStream(options):
+            self.streamSquirrels(options)
+            return
+        query = urlsplit(self.path).query
+        body, headers, encoding = self.cached(lambda encoding: listingKey(query, encoding),
+                                              lambda: self.renderSquirrels(options))
+        self.respond(200, body, "application/json", headers, encoding)
+
+    def renderSquirrels(self, options):
+        with self.readDatabase() as db:
+            body, count, lastId = db.getSquirrelsJSON(**options)
+        headers = []
+        if "limit" in options and count == options["limit"]:
+            headers.append(("X-Next-After", str(lastId)))
+            headers.append(("Link", self.nextPageLink(lastId)))
+        return bytes(body, "utf-8"), headers
+
+    def streamSquirrels(self, options):
+        # Encodes and writes one fetchmany batch at a time, so memory use does
+        # not grow with the number of rows. An error after the headers have
+        # gone out drops the connection, which the client sees as a truncated
+        # body rather than a complete one.
+        with self.readDatabase() as db:
+            batches = db.iterSquirrels(self.server.settings.stream_batch, encoded=True, **options)
+            self.startStream(200, "application/json")
+            separator = "["
+            for rows in batches:
+                self.writeStream(bytes(separator + ",".join([row[0] for row in rows]), "utf-8"))
+                separator = ","
+            self.writeStream(b"[]" if separator == "[" else b"]", zlib.Z_NO_FLUSH)
+            self.endStream()
+
+    def handleMetrics(self):
+        cache = self.server.pool.cache
+        body = self.server.metrics.render(cache.stats() if cache is not None else None)
+        self.respond(200, bytes(body, "utf-8"), "text/plain; version=0.0.4; charset=utf-8")
 
     def handleSquirrelsRetrieve(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
-        if squirrel:
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(bytes(json.dumps(squirrel), "utf-8"))
+        value = self.cached(lambda encoding: squirrelKey(squirrelId, encoding),
+                            lambda: self.renderSquirrel(squirrelId))
+        if value:
+            body, headers, encoding = value
+            self.respond(200, body, "application/json", headers, encoding)
         else:
             self.handle404()
 
+    def renderSquirrel(self, squirrelId):
+        with self.readDatabase() as db:
+            squirrel = db.getSquirrel(squirrelId)
+        if squirrel:
+            return bytes(json.dumps(squirrel), "utf-8"), []
+        return None
+
     def handleSquirrelsCreate(self):
-        db = SquirrelDB()
         body = self.getRequestData()
-        db.createSquirrel(body["name"], body["size"])
-        self.send_response(201)
-        self.end_headers()
+        with self.writeDatabase() as db:
+            db.createSquirrel(body["name"], body["size"])
+        self.respond(201)
+
+    def handleSquirrelsBulk(self):
+        try:
+            operations, errors = self.getBulkOperations()
+        except ValueError as e:
+            self.handle400(str(e))
+            return
+        with self.writeDatabase(bulk=True) as db:
+            applied = iter(db.applySquirrels(operations))
+        results = []
+        for position in range(len(operations) + len(errors)):
+            if position in errors:
+                results.append({"status": 400, "error": errors[position]})
+            else:
+                status, squirrelId = next(applied)
+                results.append({"status": status, "id": squirrelId})
+        self.respond(200, bytes(json.dumps({"results": results}), "utf-8"), "application/json")
 
     def handleSquirrelsUpdate(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
+        # SQLite also matches spellings such as "1.0" or "1e0" against id 1,
+        # so writes go by the id of the row found, which is also the id the
+        # response cache invalidates.
+        with self.writeDatabase() as db:
+            squirrel = db.getSquirrel(squirrelId)
+            if squirrel:
+                body = self.getRequestData()
+                result = db.updateSquirrel(squirrel["id"], body["name"], body["size"])
+                squirrel = not written404(result)
         if squirrel:
-            body = self.getRequestData()
-            db.updateSquirrel(squirrelId, body["name"], body["size"])
-            self.send_response(204)
-            self.end_headers()
+            self.respond(204)
         else:
             self.handle404()
 
     def handleSquirrelsDelete(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
+        with self.writeDatabase() as db:
+            squirrel = db.getSquirrel(squirrelId)
+            if squirrel:
+                squirrel = not written404(db.deleteSquirrel(squirrel["id"]))
         if squirrel:
-            db.deleteSquirrel(squirrelId)
-            self.send_response(204)
-            self.end_headers()
+            self.respond(204)
         else:
             self.handle404()
 
+    def handle400(self, message):
+        self.respond(400, bytes("400 Bad Request: %s" % message, "utf-8"), "text/plain")
+
     def handle404(self):
-        self.send_response(404)
-        self.send_header("Content-Type", "text/plain")
-        self.end_headers()
-        self.wfile.write(bytes("404 Not Found", "utf-8"))
+        self.respond(404, bytes("404 Not Found", "utf-8"), "text/plain")
+
+def written404(result):
+    # With --write-behind commit, a row seen by getSquirrel can be gone by the
+    # time the queued write commits; the queue then reports 404.
+    return result is not None and result[0] == 404
+
+def negotiateEncoding(acceptEncoding):
+    # Picks gzip or deflate from an Accept-Encoding header by q-value,
+    # preferring gzip on a tie; None means send the body as is.
+    if not acceptEncoding:
+        return None
+    weights = {}
+    for part in acceptEncoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding] = q
+    best = None
+    for coding in ("gzip", "deflate"):
+        q = weights.get(coding, weights.get("*", 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (coding, q)
+    return best and best[0]
+
+def compressBody(body, encoding, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, ENCODING_WBITS[encoding])
+    return compressor.compress(body) + compressor.flush()
+
+def bulkOperation(item):
+    if not isinstance(item, dict):
+        raise ValueError("expected a JSON object")
+    op = item.get("op", "create")
+    if op not in ("create", "update", "delete"):
+        raise ValueError("unknown op %r" % op)
+    squirrelId = None
+    if op != "create":
+        squirrelId = item.get("id")
+        if not isinstance(squirrelId, int) or isinstance(squirrelId, bool):
+            raise ValueError("%s needs an integer id" % op)
+    if op == "delete":
+        return op, squirrelId, None, None
+    name, size = item.get("name"), item.get("size")
+    if not isinstance(name, str) or not isinstance(size, str):
+        raise ValueError("%s needs string name and size" % op)
+    return op, squirrelId, name, size
+
+def routeOf(path):
+    # Collapses a request path into the route it was dispatched to, so the
+    # metrics have one series per route rather than one per id.
+    parts = urlsplit(path or "").path.split("/")
+    if len(parts) == 2 and parts[1] in ("squirrels", "_metrics"):
+        return "/" + parts[1]
+    if len(parts) == 3 and parts[1] == "squirrels":
+        return "/squirrels/_bulk" if parts[2] == "_bulk" else "/squirrels/{id}"
+    return "other"
+
+class CountingWriter:
+
+    # Wraps a handler's wfile to count the bytes written through it.
+
+    def __init__(self, f):
+        self.f = f
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        return self.f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+class PooledHTTPServer(ThreadingHTTPServer):
+
+    # ThreadingHTTPServer that hands connections to a fixed-size thread pool
+    # instead of starting a thread per connection; connections beyond the pool
+    # wait in the executor's queue.
+
+    def __init__(self, address, handlerClass, workers, bind_and_activate=True):
+        super().__init__(address, handlerClass, bind_and_activate)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="squirrel-worker")
+        self.arrivals = {}
+
+    def process_request(self, request, client_address):
+        # Time spent waiting for a worker counts towards the first request's
+        # admission deadline.
+        self.arrivals[request] = time.perf_counter()
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.arrivals.pop(request, None)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+class AsyncRequestHandler(SquirrelServerHandler):
+
+    # Runs one request that the asyncio engine has already read off the
+    # connection through the regular handler: rfile holds the raw request and
+    # wfile hands the response back to the event loop.
+
+    def __init__(self, rawRequest, wfile, client_address, server, requestCount, arrived):
+        self.requestCount = requestCount
+        self.arrived = arrived
+        self.request = None
+        self.rfile = io.BytesIO(rawRequest)
+        self.wfile = wfile
+        self.client_address = client_address
+        self.server = server
+        self.close_connection = True
+
+class AsyncResponseWriter:
+
+    # wfile for a handler running in an executor thread. Writes are buffered
+    # up to bufferSize and then passed to the event loop, and the thread waits
+    # for the transport to drain, so a streamed listing cannot outrun a slow
+    # client.
 
-def run():
-    print("squirrel_server running at 127.0.0.1:8080")
-    listen = ("127.0.0.1", 8080)
-    server = HTTPServer(listen, SquirrelServerHandler)
-    server.serve_forever()
+    def __init__(self, loop, writer, bufferSize=64 * 1024):
+        self.loop = loop
+        self.writer = writer
+        self.bufferSize = bufferSize
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        self.buffered += len(data)
+        if self.buffered >= self.bufferSize:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = b"".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        asyncio.run_coroutine_threadsafe(self.send(data), self.loop).result()
+
+    async def send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+class AsyncSquirrelServer:
+
+    # asyncio engine: connections are held by the event loop, so an idle
+    # client costs a coroutine rather than a thread. Each complete request is
+    # run through AsyncRequestHandler on the executor, where the blocking
+    # SQLite calls happen.
+
+    def __init__(self, args):
+        self.settings = args
+        self.server_name = args.host
+        self.server_port = args.port
+        self.executor = ThreadPoolExecutor(max_workers=args.threads, thread_name_prefix="squirrel-worker")
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+        server = await asyncio.start_server(self.handleConnection, self.settings.host, self.settings.port)
+        async with server:
+            await stop.wait()
+
+    async def handleConnection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        wfile = AsyncResponseWriter(loop, writer)
+        peer = writer.get_extra_info("peername")
+        requestCount = 0
+        try:
+            while True:
+                rawRequest = await asyncio.wait_for(readRequest(reader), self.settings.keep_alive_timeout)
+                if rawRequest is None:
+                    break
+                handler = await loop.run_in_executor(
+                    self.executor, self.process, rawRequest, wfile, peer, requestCount, time.perf_counter())
+                if handler.close_connection:
+                    break
+                requestCount = handler.requestCount
+        except (ConnectionError, TimeoutError, asyncio.LimitOverrunError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # The server is shutting down with this connection still open.
+            pass
+        finally:
+            writer.close()
+
+    def process(self, rawRequest, wfile, peer, requestCount, arrived):
+        handler = AsyncRequestHandler(rawRequest, wfile, peer, self, requestCount, arrived)
+        try:
+            handler.handle_one_request()
+            wfile.flush()
+        except Exception:
+            handler.close_connection = True
+            print("Exception occurred during processing of request from", peer, file=sys.stderr)
+            traceback.print_exc()
+        return handler
+
+    def server_close(self):
+        self.executor.shutdown(wait=True)
+
+async def readRequest(reader):
+    # Returns the request line, headers and Content-Length body as bytes, or
+    # None once the client has closed the connection between requests.
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if e.partial.strip():
+            raise
+        return None
+    length = 0
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            try:
+                length = int(value)
+            except ValueError:
+                length = 0
+    body = await reader.readexactly(length) if length > 0 else b""
+    return head + body
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Squirrel REST server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--db", default=DB_PATH, help="SQLite database file")
+    parser.add_argument("--pool-size", type=int, default=5,
+                        help="maximum number of open read-only database connections; writes share one "
+                             "writer connection")
+    parser.add_argument("--durability", choices=sorted(DURABILITY_PROFILES), default=DEFAULT_PROFILE,
+                        help="SQLite journal/sync profile (see squirrel_db.DURABILITY_PROFILES)")
+    parser.add_argument("--optimize-on-start", action="store_true",
+                        help="refresh the query planner's statistics (sampled ANALYZE) before serving")
+    parser.add_argument("--optimize-interval", type=float, default=0,
+                        help="also refresh them every this many seconds; 0 never does")
+    parser.add_argument("--write-behind", choices=["off"] + list(WRITE_ACK_MODES), default="off",
+                        help="queue creates, updates and deletes for one writer thread that commits them "
+                             "in batches; the request returns once its batch has committed, or as soon "
+                             "as it is queued")
+    parser.add_argument("--write-batch-items", type=int, default=500,
+                        help="most writes committed in one write-behind batch")
+    parser.add_argument("--write-batch-delay", type=float, default=2,
+                        help="milliseconds a write-behind batch waits for more writes")
+    parser.add_argument("--stream-listings", action="store_true",
+                        help="stream unpaginated GET /squirrels responses instead of buffering them")
+    parser.add_argument("--stream-batch", type=int, default=500,
+                        help="rows fetched and written per chunk when streaming")
+    parser.add_argument("--response-cache", choices=["off", "local", "shared"], default="off",
+                        help="cache GET responses in memory; 'shared' also notices writes made by "
+                             "other processes using the same database file")
+    parser.add_argument("--cache-bytes", type=int, default=DEFAULT_CACHE_BYTES,
+                        help="size bound of the response cache")
+    parser.add_argument("--cache-ttl", type=float, default=DEFAULT_CACHE_TTL,
+                        help="seconds a cached response is served before it is rebuilt")
+    parser.add_argument("--compress-level", type=int, default=6, choices=range(0, 10), metavar="0-9",
+                        help="zlib level for gzip/deflate responses; 0 turns compression off")
+    parser.add_argument("--compress-min-bytes", type=int, default=1024,
+                        help="smallest response body worth compressing")
+    parser.add_argument("--access-log", choices=["stderr", "buffered", "off"], default="stderr",
+                        help="write each request line to stderr as it happens, in batches from a "
+                             "background thread, or not at all")
+    parser.add_argument("--access-log-sample", type=float, default=1.0,
+                        help="fraction of requests to write to the access log")
+    parser.add_argument("--mode", choices=["single", "threaded", "prefork", "asyncio"], default="single",
+                        help="serve one request at a time, from a thread pool, from forked worker "
+                             "processes, or from an asyncio event loop")
+    parser.add_argument("--threads", type=int, default=16,
+                        help="worker threads per process in threaded and prefork modes, and "
+                             "database threads in asyncio mode")
+    parser.add_argument("--keep-alive-timeout", type=float, default=5,
+                        help="seconds an idle persistent connection is kept open")
+    parser.add_argument("--keep-alive-requests", type=int, default=100,
+                        help="requests served on one connection before the server closes it")
+    parser.add_argument("--max-in-flight", type=int, default=0,
+                        help="requests served at once per process before others wait or get 503; "
+                             "0 means no limit")
+    parser.add_argument("--max-queue", type=int, default=64,
+                        help="requests that may wait for a --max-in-flight slot; more get 503 at once")
+    parser.add_argument("--queue-timeout", type=float, default=1,
+                        help="seconds after arriving that a waiting request gives up with 503")
+    parser.add_argument("--retry-after", type=int, default=1,
+                        help="Retry-After seconds sent with 503 responses")
+    parser.add_argument("--rate-limit", type=float, default=0,
+                        help="requests per second allowed to each client address, after which it gets "
+                             "429; 0 means no limit")
+    parser.add_argument("--rate-burst", type=int, default=20,
+                        help="requests a client may make back to back before --rate-limit applies")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1,
+                        help="worker processes in prefork mode")
+    return parser.parse_args(argv)
+
+def createServer(args, listener=None):
+    # With a listener (prefork), the new server accepts on its socket instead
+    # of binding its own.
+    listen = (args.host, args.port)
+    bind = listener is None
+    if args.mode == "single":
+        server = HTTPServer(listen, SquirrelServerHandler, bind_and_activate=bind)
+    else:
+        server = PooledHTTPServer(listen, SquirrelServerHandler, args.threads, bind_and_activate=bind)
+    if listener:
+        server.socket.close()
+        server.socket = listener.socket
+        server.server_name = listener.server_name
+        server.server_port = listener.server_port
+    server.settings = args
+    return server
+
+def openResources(server):
+    args = server.settings
+    cache = None
+    if args.response_cache != "off":
+        watcher = DataVersionWatcher(args.db) if args.response_cache == "shared" else None
+        cache = ResponseCache(args.cache_bytes, args.cache_ttl, watcher)
+    server.metrics = Metrics()
+    server.admission = AdmissionControl(args.max_in_flight, args.max_queue) if args.max_in_flight > 0 else None
+    server.rateLimiter = RateLimiter(args.rate_limit, args.rate_burst) if args.rate_limit > 0 else None
+    server.accessLog = AccessLog(args.access_log, args.access_log_sample)
+    # One writer connection, opened first so that the file exists and is
+    # migrated before any read-only connection opens it.
+    server.pool = ConnectionPool(args.db, size=1, profile=args.durability, cache=cache, metrics=server.metrics)
+    server.pool.checkin(server.pool.checkout())
+    writer = None
+    if args.write_behind != "off":
+        writer = WriteQueue(args.db, args.durability, cache, server.metrics, args.write_batch_items,
+                            args.write_batch_delay / 1000, args.write_behind)
+    server.readers = ConnectionPool(args.db, size=args.pool_size, profile=args.durability, cache=cache,
+                                    metrics=server.metrics, writer=writer, readOnly=True)
+    server.optimizer = Optimizer(args.db, args.optimize_interval) if args.optimize_interval > 0 else None
+
+def closeResources(server):
+    if server.optimizer is not None:
+        server.optimizer.close()
+    if server.readers.writer is not None:
+        server.readers.writer.close()
+    server.readers.close()
+    server.pool.close()
+    if server.pool.cache is not None:
+        server.pool.cache.close()
+    server.accessLog.close()
+
+def serve(server):
+    # Each process opens its own connection pool: SQLite connections must not
+    # be carried across fork().
+    openResources(server)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        closeResources(server)
+
+def serveAsync(args):
+    server = AsyncSquirrelServer(args)
+    openResources(server)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        closeResources(server)
+
+def servePrefork(args):
+    # The parent binds the socket, forks the workers and replaces any that
+    # die; SIGTERM/SIGINT are passed on to the workers.
+    listener = HTTPServer((args.host, args.port), SquirrelServerHandler)
+    workers = set()
+    stopping = []
+
+    def spawn():
+        # Signals stay blocked across fork() so a worker never runs the
+        # parent's handler and the parent never misses a new pid.
+        mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM, signal.SIGINT})
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+            status = 0
+            try:
+                serve(createServer(args, listener))
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        workers.add(pid)
+        signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(args.processes):
+        if not stopping:
+            spawn()
+    while workers:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        workers.discard(pid)
+        if not stopping:
+            spawn()
+    listener.server_close()
+
+def run(argv=None):
+    args = parseArgs(argv)
+    if args.optimize_on_start:
+        connection = connect(args.db, args.durability)
+        optimize(connection)
+        connection.close()
+    print("squirrel_server running at %s:%d" % (args.host, args.port))
+    if args.mode == "prefork":
+        servePrefork(args)
+    elif args.mode == "asyncio":
+        serveAsync(args)
+    else:
+        serve(createServer(args))
 
 if __name__ == '__main__':
     run()
-
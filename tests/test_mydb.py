@@ -3,10 +3,15 @@ import pickle
 import pytest
 import sys
 import stat
+import subprocess
 import builtins
+import multiprocessing
+import threading
+import time
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from mydb import MyDB
+from mydb import MyDB, MappedRecords, ReadCache, READ_CACHE, decodedSize
+from mydb_search import SearchIndex
 
 todo = pytest.mark.skip(reason='todo: pending spec')
 
@@ -22,8 +27,14 @@ def nonempty_db(db_filename):
 @pytest.fixture(autouse=True)
 def cleanup(db_filename):
     yield
-    if os.path.exists(db_filename):
-        os.remove(db_filename)
+    for path in [db_filename] + [db_filename + ext for ext in (".log", ".idx", ".lock", ".search")]:
+        if os.path.exists(path):
+            os.remove(path)
+
+def append_many(db_filename, tag):
+    db = MyDB(db_filename, compactMinBytes=256)
+    for i in range(50):
+        db.saveString("%s-%d" % (tag, i))
 
 def describe_MyDB():
 
@@ -144,4 +155,466 @@ def describe_MyDB():
             db2 = MyDB(db_filename)
             db1.saveString("first")
             db2.saveString("second")
-            assert db1.loadStrings() == ["first", "second"]
\ No newline at end of file
+            assert db1.loadStrings() == ["first", "second"]
+
+    def describe_append_log():
+
+        def it_does_not_rewrite_pickle_file_on_append(nonempty_db, db_filename):
+            db = MyDB(db_filename)
+            db.saveString('extra')
+            with open(db_filename, 'rb') as f:
+                assert pickle.load(f) == ['stuff', 'more stuff']
+            assert os.path.isfile(db_filename + ".log")
+
+        def it_folds_log_into_pickle_file_on_checkpoint(nonempty_db, db_filename):
+            db = MyDB(db_filename)
+            db.saveString('extra')
+            db.checkpoint()
+            assert not os.path.exists(db_filename + ".log")
+            with open(db_filename, 'rb') as f:
+                assert pickle.load(f) == ['stuff', 'more stuff', 'extra']
+
+        def it_ignores_log_from_older_pickle_file(db_filename):
+            db = MyDB(db_filename)
+            db.saveString('stale')
+            os.remove(db_filename)
+            with open(db_filename, 'wb') as f:
+                pickle.dump(['fresh'], f)
+            assert db.loadStrings() == ['fresh']
+
+        def it_drops_partially_written_record(db_filename):
+            db = MyDB(db_filename)
+            db.saveString('whole')
+            with open(db_filename + ".log", 'ab') as f:
+                f.write(b"\xff\x00\x00\x00trunc")
+            assert db.loadStrings() == ['whole']
+
+        def it_compacts_when_log_outgrows_threshold(db_filename):
+            db = MyDB(db_filename, compactMinBytes=64)
+            for i in range(20):
+                db.saveString("item %d" % i)
+            assert db.loadStrings() == ["item %d" % i for i in range(20)]
+            with open(db_filename, 'rb') as f:
+                assert len(pickle.load(f)) > 10
+
+    def describe_records_format():
+
+        def it_keeps_pickle_format_by_default(db_filename):
+            db = MyDB(db_filename)
+            assert db.format == "pickle"
+
+        def it_round_trips_records_file(db_filename):
+            db = MyDB(db_filename, format="records")
+            db.saveStrings(['a', 2, {'c': 3}])
+            db.saveString('d')
+            assert db.loadStrings() == ['a', 2, {'c': 3}, 'd']
+
+        def it_detects_existing_records_file(db_filename):
+            MyDB(db_filename, format="records").saveStrings(['a', 'b'])
+            db = MyDB(db_filename)
+            assert db.format == "records"
+            assert db.loadStrings() == ['a', 'b']
+
+    def describe_iterStrings():
+
+        @pytest.fixture(params=["pickle", "records"])
+        def split_db(request, db_filename):
+            db = MyDB(db_filename, format=request.param)
+            db.saveStrings(['a', 'b', 'c'])
+            db.saveString('d')
+            db.saveString('e')
+            return db
+
+        def it_streams_data_file_then_log(split_db):
+            assert list(split_db.iterStrings()) == ['a', 'b', 'c', 'd', 'e']
+
+        def it_returns_range_across_data_file_and_log(split_db):
+            assert list(split_db.iterStrings(2, 4)) == ['c', 'd']
+            assert list(split_db.iterStrings(4)) == ['e']
+            assert list(split_db.iterStrings(3, 3)) == []
+            assert list(split_db.iterStrings(9)) == []
+
+        def it_rejects_negative_indexes(split_db):
+            with pytest.raises(ValueError):
+                list(split_db.iterStrings(-1))
+
+        def it_counts_records(split_db):
+            assert split_db.count() == 5
+
+        def it_yields_records_before_reading_the_rest(db_filename):
+            db = MyDB(db_filename, format="records")
+            db.saveStrings(['first', 'second'])
+            with open(db_filename, 'ab') as f:
+                f.write(b"\xff\xff\xff\x00")
+            it = db.iterStrings()
+            assert next(it) == 'first'
+            it.close()
+
+    def describe_random_access():
+
+        @pytest.fixture
+        def records_db(db_filename):
+            db = MyDB(db_filename, format="records")
+            db.saveStrings(['zero', 'one', 'two'])
+            db.saveString('three')
+            return db
+
+        def it_writes_offset_index_for_records_file(records_db, db_filename):
+            assert os.path.isfile(db_filename + ".idx")
+
+        def it_gets_string_by_index(records_db):
+            assert records_db.getString(0) == 'zero'
+            assert records_db.getString(2) == 'two'
+            assert records_db.getString(3) == 'three'
+            assert records_db.getString(-1) == 'three'
+
+        def it_raises_index_error_out_of_range(records_db):
+            with pytest.raises(IndexError):
+                records_db.getString(4)
+            with pytest.raises(IndexError):
+                records_db.getString(-5)
+
+        def it_gets_strings_by_range(records_db):
+            assert records_db.getStrings(1, 3) == ['one', 'two']
+            assert records_db.getStrings(2) == ['two', 'three']
+
+        def it_reports_length(records_db):
+            assert len(records_db) == 4
+            records_db.saveString('four')
+            assert len(records_db) == 5
+
+        def it_returns_memoryview_when_raw(records_db):
+            view = records_db.getString(1, raw=True)
+            assert isinstance(view, memoryview)
+            assert pickle.loads(view) == 'one'
+
+        def it_keeps_old_views_valid_after_rewrite(records_db):
+            view = records_db.getString(0, raw=True)
+            records_db.saveStrings(['replaced'])
+            assert records_db.getString(0) == 'replaced'
+            assert pickle.loads(view) == 'zero'
+
+        def it_rebuilds_missing_index(records_db, db_filename):
+            os.remove(db_filename + ".idx")
+            db = MyDB(db_filename)
+            assert db.getStrings(0, 4) == ['zero', 'one', 'two', 'three']
+            assert os.path.isfile(db_filename + ".idx")
+
+        def it_indexes_the_log_once_when_threads_share_an_instance(db_filename):
+            MyDB(db_filename, format="records").saveStrings(['zero'])
+            with MyDB(db_filename).batch() as writer:
+                for i in range(3000):
+                    writer.saveString('log %d' % i)
+            for _ in range(5):
+                db = MyDB(db_filename)
+                barrier = threading.Barrier(8)
+                results = []
+
+                def read():
+                    barrier.wait()
+                    results.append((len(db), db.getString(-1), db.getString(1500)))
+
+                threads = [threading.Thread(target=read) for _ in range(8)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                assert results == [(3001, 'log 2999', 'log 1499')] * 8
+                assert len(db) == 3001
+
+        def it_appends_without_mapping_the_data_file(records_db, db_filename, monkeypatch):
+            def fail(*args, **kwargs):
+                raise AssertionError("mapped")
+
+            monkeypatch.setattr(MappedRecords, "open", fail)
+            MyDB(db_filename).saveString('four')
+            monkeypatch.undo()
+            assert records_db.getStrings(3) == ['three', 'four']
+
+        def it_maps_the_offset_index_instead_of_reading_it(records_db, db_filename):
+            db = MyDB(db_filename)
+            assert db.getString(2) == 'two'
+            assert isinstance(db.mappedRecords.offsets, memoryview)
+
+        def it_rebuilds_a_truncated_index(records_db, db_filename):
+            with open(db_filename + ".idx", 'r+b') as f:
+                f.truncate(os.path.getsize(db_filename + ".idx") - 3)
+            assert MyDB(db_filename).getStrings(0) == ['zero', 'one', 'two', 'three']
+
+        def it_falls_back_for_pickle_files(nonempty_db, db_filename):
+            db = MyDB(db_filename)
+            db.saveString('extra')
+            assert db.getString(1) == 'more stuff'
+            assert db.getStrings(1) == ['more stuff', 'extra']
+            assert len(db) == 3
+
+    def describe_batching():
+
+        def it_saves_many_strings_at_once(nonempty_db, db_filename):
+            db = MyDB(db_filename)
+            db.saveStrings_many(iter(['x', 'y']))
+            assert db.loadStrings() == ['stuff', 'more stuff', 'x', 'y']
+
+        def it_writes_batch_on_exit(db_filename):
+            db = MyDB(db_filename)
+            with db.batch():
+                db.saveString('a')
+                db.saveStrings_many(['b', 'c'])
+                assert db.loadStrings() == []
+            assert db.loadStrings() == ['a', 'b', 'c']
+
+        def it_discards_batch_on_error(db_filename):
+            db = MyDB(db_filename)
+            db.saveString('kept')
+            with pytest.raises(RuntimeError):
+                with db.batch():
+                    db.saveString('dropped')
+                    raise RuntimeError("abort")
+            assert db.loadStrings() == ['kept']
+
+        def it_does_not_replay_buffered_appends_after_a_rewrite(db_filename):
+            db = MyDB(db_filename, groupCommitItems=3)
+            db.saveString('a')
+            db.saveStrings(['x'])
+            db.saveString('b')
+            db.saveString('c')
+            db.flush()
+            assert db.loadStrings() == ['x', 'b', 'c']
+
+        def it_checkpoints_buffered_appends(db_filename):
+            db = MyDB(db_filename, groupCommitItems=3)
+            db.saveString('a')
+            db.checkpoint()
+            assert MyDB(db_filename).loadStrings() == ['a']
+            assert not os.path.exists(db_filename + ".log")
+
+        def it_flushes_buffered_appends_at_exit(db_filename):
+            script = "import sys; sys.path.insert(0, %r); from mydb import MyDB; db = MyDB(%r, groupCommitItems=10); db.saveString('a')" % (
+                os.path.abspath(os.path.join(os.path.dirname(__file__), '..')), db_filename)
+            subprocess.run([sys.executable, "-c", script], check=True)
+            assert MyDB(db_filename).loadStrings() == ['a']
+
+        def it_group_commits_on_item_threshold(db_filename):
+            db = MyDB(db_filename, groupCommitItems=3)
+            db.saveString('a')
+            db.saveString('b')
+            assert db.loadStrings() == []
+            db.saveString('c')
+            assert db.loadStrings() == ['a', 'b', 'c']
+
+        def it_group_commits_on_time_threshold(db_filename):
+            db = MyDB(db_filename, groupCommitSeconds=0.01)
+            db.saveString('a')
+            deadline = time.time() + 2
+            while db.loadStrings() != ['a'] and time.time() < deadline:
+                time.sleep(0.01)
+            assert db.loadStrings() == ['a']
+
+        def it_flushes_pending_appends_on_close(db_filename):
+            db = MyDB(db_filename, groupCommitItems=100)
+            db.saveString('a')
+            db.close()
+            assert MyDB(db_filename).loadStrings() == ['a']
+
+    def describe_read_cache():
+
+        @pytest.fixture(autouse=True)
+        def clear_cache():
+            READ_CACHE.clear()
+
+        def it_returns_cached_list_without_decoding(nonempty_db, db_filename, monkeypatch):
+            db = MyDB(db_filename, cache=True)
+            assert db.loadStrings() == ['stuff', 'more stuff']
+
+            def fail(*args, **kwargs):
+                raise AssertionError("decoded again")
+
+            monkeypatch.setattr(pickle, "load", fail)
+            monkeypatch.setattr(pickle, "loads", fail)
+            assert db.loadStrings() == ['stuff', 'more stuff']
+
+        def it_returns_a_copy(nonempty_db, db_filename):
+            db = MyDB(db_filename, cache=True)
+            db.loadStrings().append('mutated')
+            assert db.loadStrings() == ['stuff', 'more stuff']
+
+        def it_sees_writes_from_other_instances(nonempty_db, db_filename):
+            db = MyDB(db_filename, cache=True)
+            db.loadStrings()
+            MyDB(db_filename).saveString('appended')
+            assert db.loadStrings() == ['stuff', 'more stuff', 'appended']
+            MyDB(db_filename).saveStrings(['replaced'])
+            assert db.loadStrings() == ['replaced']
+
+        def it_evicts_least_recently_used_entries(db_filename):
+            cache = ReadCache(maxBytes=decodedSize(['a' * 60]) * 3 // 2)
+            other = db_filename + ".other"
+            try:
+                a = MyDB(db_filename, cache=cache)
+                b = MyDB(other, cache=cache)
+                a.saveStrings(['a' * 60])
+                b.saveStrings(['b' * 60])
+                a.loadStrings()
+                b.loadStrings()
+                assert list(cache.entries) == [b.cacheKey]
+                assert cache.totalBytes <= cache.maxBytes
+            finally:
+                for path in (other, other + ".lock"):
+                    os.remove(path)
+
+        def it_charges_the_decoded_size_of_compressed_files(db_filename):
+            cache = ReadCache()
+            db = MyDB(db_filename, codec="utf8", compression="lzma", cache=cache)
+            items = ['squirrel'] * 10000
+            db.saveStrings(items)
+            db.loadStrings()
+            assert cache.totalBytes > sum(map(sys.getsizeof, items))
+            assert cache.totalBytes > 10 * os.path.getsize(db_filename)
+
+    def describe_multi_process_access():
+
+        def it_does_not_lose_appends_across_processes(db_filename):
+            MyDB(db_filename)
+            ctx = multiprocessing.get_context("fork")
+            workers = [ctx.Process(target=append_many, args=(db_filename, tag)) for tag in "abcd"]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            items = MyDB(db_filename).loadStrings()
+            assert sorted(items) == sorted("%s-%d" % (tag, i) for tag in "abcd" for i in range(50))
+
+        def it_does_not_lose_appends_across_threads(db_filename):
+            MyDB(db_filename)
+            threads = [threading.Thread(target=append_many, args=(db_filename, tag)) for tag in "abcd"]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert len(MyDB(db_filename).loadStrings()) == 200
+
+        def it_never_leaves_temporary_files(db_filename):
+            db = MyDB(db_filename)
+            db.saveStrings(['a'])
+            db.checkpoint()
+            directory = os.path.dirname(os.path.abspath(db_filename))
+            assert not [f for f in os.listdir(directory) if f.endswith(".tmp")]
+
+    def describe_codecs():
+
+        @pytest.fixture(params=[
+            ("pickle", None), ("pickle", "zlib"), ("pickle", "lzma"),
+            ("utf8", None), ("utf8", "zlib"), ("utf8", "lzma"),
+        ])
+        def codec_db(request, db_filename):
+            codec, compression = request.param
+            db = MyDB(db_filename, codec=codec, compression=compression)
+            db.saveStrings(['alpha', 'beta', 'gamma', 'beta'])
+            db.saveString('delta')
+            return db
+
+        def it_round_trips_through_every_codec(codec_db):
+            assert codec_db.loadStrings() == ['alpha', 'beta', 'gamma', 'beta', 'delta']
+
+        def it_supports_ranges_and_counts(codec_db):
+            assert codec_db.getStrings(1, 4) == ['beta', 'gamma', 'beta']
+            assert list(codec_db.iterStrings(3)) == ['beta', 'delta']
+            assert len(codec_db) == 5
+
+        def it_records_codec_in_file_header(codec_db, db_filename):
+            db = MyDB(db_filename)
+            assert db.codec == codec_db.codec
+            assert db.compression == codec_db.compression
+            assert db.loadStrings() == codec_db.loadStrings()
+
+        def it_rejects_non_strings_in_utf8_codec(db_filename):
+            db = MyDB(db_filename, codec="utf8")
+            with pytest.raises(TypeError):
+                db.saveStrings([1])
+
+        def it_stores_utf8_records_as_raw_bytes(db_filename):
+            db = MyDB(db_filename, codec="utf8")
+            db.saveStrings(['héllo'])
+            assert bytes(db.getString(0, raw=True)) == 'héllo'.encode('utf-8')
+
+        def it_shrinks_repetitive_data_when_compressed(db_filename):
+            items = ['squirrel %d' % (i % 10) for i in range(2000)]
+            plain = MyDB(db_filename, codec="utf8")
+            plain.saveStrings(items)
+            plainSize = os.path.getsize(db_filename)
+            packed = MyDB(db_filename, codec="utf8", compression="zlib")
+            packed.saveStrings(items)
+            assert os.path.getsize(db_filename) < plainSize / 10
+
+        @pytest.mark.parametrize("option", [{"format": "recods"}, {"codec": "utf-8"}, {"compression": "gzip"}])
+        def it_rejects_unknown_options(db_filename, option):
+            with pytest.raises(ValueError):
+                MyDB(db_filename, **option)
+            assert not os.path.exists(db_filename)
+
+        def it_rejects_compression_for_pickle_format(db_filename):
+            with pytest.raises(ValueError):
+                MyDB(db_filename, format="pickle", compression="zlib")
+
+    def describe_search():
+
+        @pytest.fixture(params=["pickle", "records"])
+        def search_db(request, db_filename):
+            db = MyDB(db_filename, format=request.param)
+            db.saveStrings(['apple', 'apricot', 'banana', 42, 'grape'])
+            db.saveString('pineapple')
+            db.saveString('applesauce')
+            return db
+
+        def it_finds_strings_by_prefix(search_db):
+            assert search_db.findPrefix('ap') == ['apple', 'apricot', 'applesauce']
+            assert search_db.findPrefix('pine') == ['pineapple']
+            assert search_db.findPrefix('zzz') == []
+
+        def it_finds_strings_by_substring(search_db):
+            assert search_db.contains('apple') == ['apple', 'pineapple', 'applesauce']
+            assert search_db.contains('nan') == ['banana']
+            assert search_db.contains('an') == ['banana']
+            assert search_db.contains('kiwi') == []
+
+        def it_persists_index_for_the_data_file(search_db, db_filename):
+            search_db.findPrefix('a')
+            assert os.path.isfile(db_filename + ".search")
+
+        def it_picks_up_new_appends(search_db):
+            assert search_db.findPrefix('grape') == ['grape']
+            search_db.saveString('grapefruit')
+            MyDB(search_db.fname).saveString('grapes')
+            assert search_db.findPrefix('grape') == ['grape', 'grapefruit', 'grapes']
+
+        def it_sees_full_rewrites(search_db):
+            search_db.contains('apple')
+            MyDB(search_db.fname).saveStrings(['cherry'])
+            assert search_db.contains('apple') == []
+            assert search_db.findPrefix('ch') == ['cherry']
+
+        def it_reads_the_persisted_index_without_unpickling(db_filename, monkeypatch):
+            MyDB(db_filename, codec="utf8").saveStrings(['apple', 'banana', 'grüne äpfel'])
+            MyDB(db_filename).findPrefix('a')
+
+            def fail(*args, **kwargs):
+                raise AssertionError("unpickled or rebuilt")
+
+            monkeypatch.setattr(pickle, "load", fail)
+            monkeypatch.setattr(pickle, "loads", fail)
+            monkeypatch.setattr(SearchIndex, "build", fail)
+            db = MyDB(db_filename)
+            assert db.findPrefix('b') == ['banana']
+            assert db.contains('äpf') == ['grüne äpfel']
+
+        def it_rebuilds_a_truncated_index(search_db, db_filename):
+            search_db.findPrefix('a')
+            with open(db_filename + ".search", 'r+b') as f:
+                f.truncate(os.path.getsize(db_filename + ".search") - 3)
+            assert MyDB(db_filename).findPrefix('ap') == ['apple', 'apricot', 'applesauce']
+
+        def it_writes_index_on_save_when_asked(db_filename):
+            db = MyDB(db_filename, searchIndex=True)
+            db.saveStrings(['one', 'two'])
+            assert os.path.isfile(db_filename + ".search")
+            assert db.findPrefix('t') == ['two']
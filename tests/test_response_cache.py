@@ -0,0 +1,134 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+
+from response_cache import ResponseCache, listingKey, squirrelKey
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class FakeWatcher:
+
+    def __init__(self):
+        self.dirty = False
+        self.closed = False
+
+    def changed(self):
+        dirty, self.dirty = self.dirty, False
+        return dirty
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+@pytest.fixture
+def cache(clock):
+    return ResponseCache(maxBytes=100, ttl=10, clock=clock)
+
+def store(cache, key, body):
+    cache.put(key, (body, []), cache.validate())
+
+def describe_ResponseCache():
+
+    def it_returns_what_was_put(cache):
+        store(cache, listingKey(""), b"[]")
+        assert cache.get(listingKey("")) == (b"[]", [])
+
+    def it_counts_hits_and_misses(cache):
+        cache.get(listingKey(""))
+        store(cache, listingKey(""), b"[]")
+        cache.get(listingKey(""))
+        cache.get(listingKey(""))
+        stats = cache.stats()
+        assert (stats["hits"], stats["misses"], stats["entries"], stats["bytes"]) == (2, 1, 1, 2)
+
+    def it_does_not_count_misses_of_a_probe(cache):
+        store(cache, listingKey(""), b"[]")
+        assert cache.get(listingKey("", "gzip"), countMiss=False) is None
+        assert cache.get(listingKey(""), countMiss=False) is not None
+        stats = cache.stats()
+        assert (stats["hits"], stats["misses"]) == (1, 0)
+
+    def it_expires_entries_after_the_ttl(cache, clock):
+        store(cache, listingKey(""), b"[]")
+        clock.now = 9.9
+        assert cache.get(listingKey("")) is not None
+        clock.now = 10
+        assert cache.get(listingKey("")) is None
+        assert cache.stats()["entries"] == 0
+
+    def it_evicts_least_recently_used_entries_over_the_byte_bound(cache):
+        store(cache, squirrelKey(1), b"a" * 40)
+        store(cache, squirrelKey(2), b"b" * 40)
+        cache.get(squirrelKey(1))
+        store(cache, squirrelKey(3), b"c" * 40)
+        assert cache.get(squirrelKey(2)) is None
+        assert cache.get(squirrelKey(1)) is not None
+        assert cache.get(squirrelKey(3)) is not None
+        assert cache.stats()["evictions"] == 1
+
+    def it_skips_values_larger_than_the_whole_cache(cache):
+        store(cache, squirrelKey(1), b"x" * 101)
+        assert cache.get(squirrelKey(1)) is None
+
+    def it_counts_headers_towards_the_size(cache):
+        cache.put(listingKey(""), (b"[]", [("Link", "next")]), cache.generation)
+        assert cache.stats()["bytes"] == 10
+
+    def it_drops_listings_and_the_written_squirrel_on_invalidate(cache):
+        store(cache, listingKey(""), b"[]")
+        store(cache, listingKey("limit=1"), b"[]")
+        store(cache, squirrelKey(1), b"{}")
+        store(cache, squirrelKey(2), b"{}")
+        cache.invalidate("1")
+        assert cache.get(listingKey("")) is None
+        assert cache.get(listingKey("limit=1")) is None
+        assert cache.get(squirrelKey(1)) is None
+        assert cache.get(squirrelKey(2)) is not None
+
+    def it_keeps_single_squirrels_when_one_is_created(cache):
+        store(cache, listingKey(""), b"[]")
+        store(cache, squirrelKey(1), b"{}")
+        cache.invalidate()
+        assert cache.get(listingKey("")) is None
+        assert cache.get(squirrelKey(1)) is not None
+
+    def it_ignores_puts_built_before_an_invalidation(cache):
+        generation = cache.validate()
+        cache.invalidate()
+        cache.put(listingKey(""), (b"[]", []), generation)
+        assert cache.get(listingKey("")) is None
+
+    def it_clears_when_the_watcher_reports_a_change(clock):
+        watcher = FakeWatcher()
+        cache = ResponseCache(maxBytes=100, ttl=10, watcher=watcher, clock=clock)
+        store(cache, squirrelKey(1), b"{}")
+        generation = cache.validate()
+        assert cache.get(squirrelKey(1)) is not None
+        watcher.dirty = True
+        assert cache.validate() != generation
+        assert cache.get(squirrelKey(1)) is None
+        cache.close()
+        assert watcher.closed
+
+def describe_squirrelKey():
+
+    def it_normalizes_integer_ids():
+        assert squirrelKey("007") == squirrelKey(7)
+
+    def it_does_not_key_other_ids():
+        assert squirrelKey("abc") is None
+        assert squirrelKey(None) is None
+
+    def it_does_not_key_ids_sqlite_would_not_match():
+        for squirrelId in ("1_0", "+10", " 10", "10 ", "-1", "١٠", ""):
+            assert squirrelKey(squirrelId) is None
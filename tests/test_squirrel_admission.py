@@ -0,0 +1,68 @@
+import os
+import sys
+import threading
+import time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+
+from squirrel_admission import AdmissionControl, RateLimiter
+
+def describe_AdmissionControl():
+
+    def it_admits_up_to_the_limit_then_queues():
+        admission = AdmissionControl(2, maxQueue=1)
+        assert admission.admit(time.perf_counter() + 1)
+        assert admission.admit(time.perf_counter() + 1)
+        admitted = []
+        waiter = threading.Thread(target=lambda: admitted.append(admission.admit(time.perf_counter() + 5)))
+        waiter.start()
+        while admission.waiting == 0:
+            time.sleep(0.01)
+        # The queue holds one waiter, so the next request is turned away.
+        assert not admission.admit(time.perf_counter() + 5)
+        admission.release()
+        waiter.join()
+        assert admitted == [True]
+        assert admission.inFlight == 2
+
+    def it_gives_up_at_the_deadline():
+        admission = AdmissionControl(1)
+        assert admission.admit(time.perf_counter() + 1)
+        start = time.perf_counter()
+        assert not admission.admit(start + 0.1)
+        assert 0.1 <= time.perf_counter() - start < 1
+        assert not admission.admit(start - 1)
+        assert admission.waiting == 0
+
+    def it_turns_away_requests_already_past_their_deadline():
+        admission = AdmissionControl(2)
+        assert not admission.admit(time.perf_counter() - 0.1)
+        assert admission.inFlight == 0
+
+def describe_RateLimiter():
+
+    @pytest.fixture
+    def clock():
+        now = [100.0]
+        return now
+
+    def it_allows_a_burst_then_the_rate(clock):
+        limiter = RateLimiter(2, 3, clock=lambda: clock[0])
+        assert [limiter.acquire("10.0.0.1") for _ in range(3)] == [0, 0, 0]
+        assert limiter.acquire("10.0.0.1") == pytest.approx(0.5)
+        clock[0] += 0.5
+        assert limiter.acquire("10.0.0.1") == 0
+        assert limiter.acquire("10.0.0.1") > 0
+
+    def it_keeps_a_bucket_per_client(clock):
+        limiter = RateLimiter(1, 1, clock=lambda: clock[0])
+        assert limiter.acquire("10.0.0.1") == 0
+        assert limiter.acquire("10.0.0.1") > 0
+        assert limiter.acquire("10.0.0.2") == 0
+
+    def it_forgets_the_least_recently_seen_clients(clock):
+        limiter = RateLimiter(1, 1, maxClients=2, clock=lambda: clock[0])
+        for client in ("a", "b", "c"):
+            limiter.acquire(client)
+        assert list(limiter.buckets) == ["b", "c"]
+        assert limiter.acquire("a") == 0
@@ -0,0 +1,330 @@
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+
+from response_cache import ResponseCache, listingKey, squirrelKey
+import squirrel_db
+from squirrel_db import DURABILITY_PROFILES, ConnectionPool, DataVersionWatcher, PoolTimeout, SquirrelDB, WriteQueue, connect
+from squirrel_metrics import Metrics
+
+EMPTY_DB_PATH = os.path.join(os.path.dirname(__file__), "..", "empty_squirrel_db.db")
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "squirrel_db.db")
+    shutil.copyfile(EMPTY_DB_PATH, path)
+    return path
+
+@pytest.fixture
+def pool(db_path):
+    pool = ConnectionPool(db_path, size=2, timeout=0.1)
+    yield pool
+    pool.close()
+
+def describe_ConnectionPool():
+
+    def it_reuses_connections(pool):
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            pass
+        assert first is second
+
+    def it_reuses_the_outer_connection_when_nested(pool):
+        with pool.connection() as outer:
+            with pool.connection() as inner:
+                assert inner is outer
+
+    def it_lends_a_connection_to_one_thread_at_a_time(pool):
+        seen = []
+
+        def borrow():
+            with pool.connection() as connection:
+                seen.append(connection)
+
+        with pool.connection() as mine:
+            thread = threading.Thread(target=borrow)
+            thread.start()
+            thread.join()
+        assert seen[0] is not mine
+
+    def it_times_out_when_exhausted(pool):
+        entries = [pool.checkout(), pool.checkout()]
+        with pytest.raises(PoolTimeout):
+            pool.checkout()
+        for entry in entries:
+            pool.checkin(entry)
+
+    def it_reconnects_when_database_file_is_replaced(pool, db_path):
+        with pool.squirrelDB() as db:
+            db.createSquirrel("Fluffy", "large")
+        os.remove(db_path)
+        shutil.copyfile(EMPTY_DB_PATH, db_path)
+        with pool.squirrelDB() as db:
+            assert db.getSquirrels() == []
+
+    def it_discards_connection_after_error(pool):
+        with pytest.raises(RuntimeError):
+            with pool.connection() as broken:
+                raise RuntimeError("boom")
+        with pool.connection() as fresh:
+            assert fresh is not broken
+
+    def it_rolls_back_uncommitted_work(pool):
+        with pool.connection() as connection:
+            connection.execute("INSERT INTO squirrels (name, size) VALUES ('Ghost', 'tiny')")
+        with pool.squirrelDB() as db:
+            assert db.getSquirrels() == []
+
+    def it_refuses_checkout_after_close(pool):
+        pool.close()
+        with pytest.raises(PoolTimeout):
+            with pool.connection():
+                pass
+
+def describe_SquirrelDB():
+
+    def it_accepts_an_existing_connection(pool):
+        with pool.connection() as connection:
+            db = SquirrelDB(connection)
+            db.createSquirrel("Fluffy", "large")
+            assert db.getSquirrel(1) == {"id": 1, "name": "Fluffy", "size": "large"}
+
+    def it_invalidates_the_pool_cache_on_writes(db_path):
+        cache = ResponseCache()
+        pool = ConnectionPool(db_path, cache=cache)
+        with pool.squirrelDB() as db:
+            db.createSquirrel("Fluffy", "large")
+            cache.put(listingKey(""), (b"[]", []), cache.generation)
+            cache.put(squirrelKey(1), (b"{}", []), cache.generation)
+            db.updateSquirrel(1, "Fluffy", "small")
+            assert cache.get(listingKey("")) is None
+            assert cache.get(squirrelKey(1)) is None
+            cache.put(squirrelKey(1), (b"{}", []), cache.generation)
+            db.deleteSquirrel("1")
+            assert cache.get(squirrelKey(1)) is None
+        pool.close()
+
+def describe_bulk_writes():
+
+    @pytest.fixture
+    def db(pool):
+        with pool.squirrelDB() as db:
+            yield db
+
+    def it_creates_a_batch_and_returns_the_ids(db):
+        db.createSquirrel("First", "small")
+        assert db.createSquirrels([("Fluffy", "large"), ("Nutty", "small")]) == [2, 3]
+        assert db.getSquirrel(3) == {"id": 3, "name": "Nutty", "size": "small"}
+        assert not db.connection.in_transaction
+
+    @pytest.mark.parametrize("rowFactory", ["tuple", "row"])
+    def it_creates_a_batch_whatever_the_row_type(db_path, rowFactory):
+        db = SquirrelDB(connect(db_path, rowFactory=rowFactory))
+        assert db.createSquirrels([("Fluffy", "large"), ("Nutty", "small")]) == [1, 2]
+        db.connection.close()
+
+    def it_creates_nothing_for_an_empty_batch(db):
+        assert db.createSquirrels([]) == []
+
+    def it_applies_mixed_operations_with_per_item_results(db):
+        db.createSquirrels([("Fluffy", "large"), ("Nutty", "small")])
+        results = db.applySquirrels([
+            ("create", None, "Bushy", "large"),
+            ("create", None, "Rocky", "tiny"),
+            ("update", 1, "Fluffy", "huge"),
+            ("delete", 2, None, None),
+            ("delete", 99, None, None),
+            ("create", None, "Last", "small"),
+        ])
+        assert results == [(201, 3), (201, 4), (204, 1), (204, 2), (404, 99), (201, 5)]
+        assert [s["name"] for s in db.getSquirrels()] == ["Fluffy", "Bushy", "Rocky", "Last"]
+        assert db.getSquirrel(1)["size"] == "huge"
+
+    def it_rolls_back_the_whole_batch_on_error(db):
+        with pytest.raises(ValueError):
+            db.applySquirrels([("create", None, "Fluffy", "large"), ("explode", 1, None, None)])
+        assert db.getSquirrels() == []
+
+    def it_invalidates_the_cache_once_committed(db_path):
+        cache = ResponseCache()
+        pool = ConnectionPool(db_path, cache=cache)
+        with pool.squirrelDB() as db:
+            db.createSquirrel("Fluffy", "large")
+            cache.put(listingKey(""), (b"[]", []), cache.generation)
+            cache.put(squirrelKey(1), (b"{}", []), cache.generation)
+            db.applySquirrels([("update", 1, "Fluffy", "small")])
+            assert cache.get(listingKey("")) is None
+            assert cache.get(squirrelKey(1)) is None
+        pool.close()
+
+def describe_WriteQueue():
+
+    def it_commits_queued_writes_in_one_batch(db_path):
+        metrics = Metrics()
+        writer = WriteQueue(db_path, metrics=metrics, maxDelay=0.2)
+        futures = [writer.submit("create", None, "Fluffy %d" % i, "large") for i in range(10)]
+        assert [future.result() for future in futures] == [(201, i) for i in range(1, 11)]
+        writer.close()
+        assert metrics.queries["applySquirrels"].count == 1
+
+    def it_flushes_a_batch_once_it_is_full(db_path):
+        metrics = Metrics()
+        writer = WriteQueue(db_path, metrics=metrics, maxItems=3, maxDelay=10)
+        futures = [writer.submit("create", None, "Fluffy", "large") for _ in range(3)]
+        assert [future.result(timeout=5) for future in futures] == [(201, 1), (201, 2), (201, 3)]
+        writer.close()
+
+    def it_routes_squirrel_db_writes_through_the_queue(db_path):
+        writer = WriteQueue(db_path)
+        pool = ConnectionPool(db_path, writer=writer)
+        with pool.squirrelDB() as db:
+            db.createSquirrel("Fluffy", "large")
+            assert db.getSquirrel(1) == {"id": 1, "name": "Fluffy", "size": "large"}
+            db.updateSquirrel(1, "Fluffy", "small")
+            assert db.getSquirrel(1)["size"] == "small"
+            db.deleteSquirrel(1)
+            assert db.getSquirrel(1) is None
+        writer.close()
+        pool.close()
+
+    def it_reports_missing_rows_of_queued_writes(db_path):
+        writer = WriteQueue(db_path)
+        pool = ConnectionPool(db_path, writer=writer)
+        with pool.squirrelDB() as db:
+            db.createSquirrel("Fluffy", "large")
+            assert db.updateSquirrel(1, "Fluffy", "small") == (204, 1)
+            assert db.deleteSquirrel(1) == (204, 1)
+            assert db.updateSquirrel(1, "Fluffy", "small") == (404, 1)
+            assert db.deleteSquirrel(1) == (404, 1)
+        writer.close()
+        pool.close()
+
+    def it_fails_only_the_bad_operation_of_a_batch(db_path):
+        writer = WriteQueue(db_path, maxDelay=0.2)
+        good = writer.submit("create", None, "Fluffy", "large")
+        bad = writer.submit("explode", 1)
+        assert good.result() == (201, 1)
+        with pytest.raises(ValueError):
+            bad.result()
+        writer.close()
+
+    def it_commits_enqueued_writes_on_close(db_path):
+        writer = WriteQueue(db_path, maxDelay=10, ack="enqueue")
+        assert writer.write("create", None, "Fluffy", "large") is None
+        writer.close()
+        assert SquirrelDB(connect(db_path)).getSquirrel(1)["name"] == "Fluffy"
+        with pytest.raises(RuntimeError):
+            writer.submit("create", None, "Late", "small")
+
+    def it_rejects_unknown_ack_modes(db_path):
+        with pytest.raises(ValueError):
+            WriteQueue(db_path, ack="eventually")
+
+def describe_DataVersionWatcher():
+
+    def it_notices_commits_from_other_connections(db_path):
+        watcher = DataVersionWatcher(db_path)
+        assert watcher.changed()
+        assert not watcher.changed()
+        SquirrelDB(connect(db_path)).createSquirrel("Fluffy", "large")
+        assert watcher.changed()
+        assert not watcher.changed()
+        watcher.close()
+
+    def it_notices_the_file_being_replaced(db_path):
+        watcher = DataVersionWatcher(db_path)
+        watcher.changed()
+        os.remove(db_path)
+        shutil.copyfile(EMPTY_DB_PATH, db_path)
+        assert watcher.changed()
+        assert not watcher.changed()
+        watcher.close()
+
+def describe_connect():
+
+    @pytest.mark.parametrize("profile", sorted(DURABILITY_PROFILES))
+    def it_applies_durability_profile(db_path, profile):
+        connection = connect(db_path, profile)
+        settings = DURABILITY_PROFILES[profile]
+        journal = connection.execute("PRAGMA journal_mode").fetchone()
+        assert list(journal.values())[0].upper() == settings["journal_mode"]
+        timeout = connection.execute("PRAGMA busy_timeout").fetchone()
+        assert list(timeout.values())[0] == settings["busy_timeout"]
+        connection.close()
+
+    def it_rejects_unknown_profile(db_path):
+        with pytest.raises(ValueError):
+            connect(db_path, "reckless")
+
+    def it_returns_rows_as_the_chosen_type(db_path):
+        SquirrelDB(connect(db_path)).createSquirrel("Fluffy", "large")
+        row = connect(db_path, rowFactory="row").execute("SELECT * FROM squirrels").fetchone()
+        assert isinstance(row, sqlite3.Row) and row["name"] == "Fluffy"
+        assert connect(db_path, rowFactory="tuple").execute("SELECT * FROM squirrels").fetchone() == (1, "Fluffy", "large")
+        with pytest.raises(ValueError):
+            connect(db_path, rowFactory="namedtuple")
+
+    @pytest.mark.parametrize("profile", ["safe", "balanced"])
+    def it_opens_read_only_connections(db_path, profile):
+        writer = SquirrelDB(connect(db_path, profile))
+        reader = SquirrelDB(connect(db_path, profile, readOnly=True))
+        writer.createSquirrel("Fluffy", "large")
+        assert reader.getSquirrel(1)["name"] == "Fluffy"
+        with pytest.raises(sqlite3.OperationalError):
+            reader.createSquirrel("Nutty", "small")
+        assert list(reader.connection.execute("PRAGMA query_only").fetchone().values()) == [1]
+
+    def it_names_dict_columns_after_each_query(db_path):
+        connection = connect(db_path)
+        assert connection.execute("SELECT 1 AS a, 2 AS b").fetchone() == {"a": 1, "b": 2}
+        assert connection.execute("SELECT 3 AS c").fetchone() == {"c": 3}
+
+def describe_getSquirrels():
+
+    @pytest.fixture
+    def db(pool):
+        with pool.squirrelDB() as db:
+            for name, size in [("Fluffy", "large"), ("Nutty", "small"), ("Fluffy", "small"), ("Bushy", "large")]:
+                db.createSquirrel(name, size)
+            yield db
+
+    def it_pages_by_id(db):
+        assert [s["id"] for s in db.getSquirrels(limit=2)] == [1, 2]
+        assert [s["id"] for s in db.getSquirrels(after=2, limit=2)] == [3, 4]
+        assert db.getSquirrels(after=4, limit=2) == []
+
+    def it_projects_fields(db):
+        assert db.getSquirrels(fields=["name"], limit=1) == [{"name": "Fluffy"}]
+
+    def it_filters_by_name_and_size(db):
+        assert [s["id"] for s in db.getSquirrels(name="Fluffy")] == [1, 3]
+        assert [s["id"] for s in db.getSquirrels(size="large", after=1)] == [4]
+
+    def it_rejects_unknown_fields(db):
+        with pytest.raises(ValueError):
+            db.getSquirrels(fields=["id; DROP TABLE squirrels"])
+
+    @pytest.mark.parametrize("sqliteJSON", [True, False])
+    def it_encodes_listings_straight_to_json(db, monkeypatch, sqliteJSON):
+        monkeypatch.setattr(squirrel_db, "SQLITE_JSON", sqliteJSON and squirrel_db.SQLITE_JSON)
+        text, count, lastId = db.getSquirrelsJSON()
+        assert (json.loads(text), count, lastId) == (db.getSquirrels(), 4, 4)
+        text, count, lastId = db.getSquirrelsJSON(fields=["name"], size="large", limit=1)
+        assert (json.loads(text), count, lastId) == ([{"name": "Fluffy"}], 1, 1)
+        assert db.getSquirrelsJSON(after=4) == ("[]", 0, None)
+        batches = list(db.iterSquirrels(3, encoded=True, fields=["size", "id"]))
+        assert [[(json.loads(text), squirrelId) for text, squirrelId in rows] for rows in batches] == [
+            [({"size": "large", "id": 1}, 1), ({"size": "small", "id": 2}, 2), ({"size": "small", "id": 3}, 3)],
+            [({"size": "large", "id": 4}, 4)],
+        ]
+
+    def it_uses_indexes_for_filters(db):
+        plan = db.connection.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM squirrels WHERE size = ? AND id > ? ORDER BY id", ["large", 0]).fetchall()
+        assert any("squirrels_size_id" in row["detail"] for row in plan)
@@ -0,0 +1,89 @@
+import io
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+
+from squirrel_metrics import AccessLog, Histogram, Metrics
+
+def describe_Histogram():
+
+    def it_renders_cumulative_buckets():
+        histogram = Histogram(buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        lines = []
+        histogram.render("latency", (("route", "/squirrels"),), lines)
+        assert lines == [
+            'latency_bucket{route="/squirrels",le="0.1"} 2',
+            'latency_bucket{route="/squirrels",le="1.0"} 3',
+            'latency_bucket{route="/squirrels",le="+Inf"} 4',
+            'latency_sum{route="/squirrels"} 3.65',
+            'latency_count{route="/squirrels"} 4',
+        ]
+
+def describe_Metrics():
+
+    def it_counts_requests_by_route_method_and_status():
+        metrics = Metrics()
+        for status in (200, 200, 404):
+            metrics.requestStarted()
+            metrics.requestFinished("/squirrels/{id}", "GET", status, 0.002, 50)
+        text = metrics.render()
+        assert 'squirrel_http_requests_total{route="/squirrels/{id}",method="GET",status="200"} 2' in text
+        assert 'squirrel_http_requests_total{route="/squirrels/{id}",method="GET",status="404"} 1' in text
+        assert 'squirrel_http_request_duration_seconds_count{route="/squirrels/{id}"} 3' in text
+        assert 'squirrel_http_response_bytes_total{route="/squirrels/{id}"} 150' in text
+        assert "squirrel_http_requests_in_flight 0" in text
+
+    def it_tracks_requests_in_flight():
+        metrics = Metrics()
+        metrics.requestStarted()
+        assert "squirrel_http_requests_in_flight 1" in metrics.render()
+
+    def it_records_query_times():
+        metrics = Metrics()
+        metrics.observeQuery("getSquirrel", 0.0001)
+        assert 'squirrel_db_query_duration_seconds_count{method="getSquirrel"} 1' in metrics.render()
+
+    def it_includes_cache_stats_when_given():
+        stats = {"hits": 3, "misses": 1, "evictions": 0, "invalidations": 2, "entries": 1, "bytes": 10}
+        text = Metrics().render(stats)
+        assert "squirrel_response_cache_hits_total 3" in text
+        assert "squirrel_response_cache_bytes 10" in text
+
+def describe_AccessLog():
+
+    def it_writes_through_to_the_stream():
+        stream = io.StringIO()
+        AccessLog("stderr", stream=stream).write("line\n")
+        assert stream.getvalue() == "line\n"
+
+    def it_buffers_until_flushed():
+        stream = io.StringIO()
+        log = AccessLog("buffered", stream=stream, flushInterval=60)
+        log.write("one\n")
+        log.write("two\n")
+        assert stream.getvalue() == ""
+        log.close()
+        assert stream.getvalue() == "one\ntwo\n"
+
+    def it_flushes_a_full_buffer():
+        stream = io.StringIO()
+        log = AccessLog("buffered", stream=stream, flushInterval=60, bufferBytes=8)
+        log.write("12345\n")
+        log.write("12345\n")
+        assert stream.getvalue() == "12345\n12345\n"
+        log.close()
+
+    def it_drops_everything_when_off():
+        stream = io.StringIO()
+        log = AccessLog("off", stream=stream)
+        assert not log.sample()
+        log.write("line\n")
+        assert stream.getvalue() == ""
+
+    @pytest.mark.parametrize("rate, expected", [(1.0, 1000), (0.0, 0)])
+    def it_samples_request_lines(rate, expected):
+        log = AccessLog("stderr", sampleRate=rate, stream=io.StringIO())
+        assert sum(log.sample() for _ in range(1000)) == expected
@@ -0,0 +1,78 @@
+import os
+import shutil
+import sqlite3
+import sys
+import time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+
+from squirrel_db import SquirrelDB, connect, listQuery
+from squirrel_schema import SCHEMA_VERSION, Optimizer, SchemaError, migrate, optimize, schemaVersion
+
+EMPTY_DB_PATH = os.path.join(os.path.dirname(__file__), "..", "empty_squirrel_db.db")
+
+def query_plan(connection, **options):
+    sql, data = listQuery(**options)
+    return " ".join(row[3] for row in connection.execute("EXPLAIN QUERY PLAN " + sql, data))
+
+def describe_migrate():
+
+    def it_creates_the_schema_in_a_new_file(tmp_path):
+        connection = sqlite3.connect(str(tmp_path / "new.db"))
+        assert migrate(connection) == SCHEMA_VERSION
+        assert schemaVersion(connection) == SCHEMA_VERSION
+        indexes = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert {"squirrels_name_id", "squirrels_size_id"} <= indexes
+        connection.close()
+
+    def it_upgrades_a_copied_database_and_keeps_its_rows(tmp_path):
+        path = str(tmp_path / "squirrel_db.db")
+        shutil.copyfile(EMPTY_DB_PATH, path)
+        connection = sqlite3.connect(path)
+        connection.execute("INSERT INTO squirrels (name, size) VALUES ('Fluffy', 'large')")
+        connection.commit()
+        assert schemaVersion(connection) == 0
+        assert migrate(connection) == SCHEMA_VERSION
+        assert connection.execute("SELECT name FROM squirrels").fetchall() == [("Fluffy",)]
+        assert migrate(connection) == SCHEMA_VERSION
+        connection.close()
+
+    def it_refuses_a_schema_newer_than_the_code(tmp_path):
+        connection = sqlite3.connect(str(tmp_path / "new.db"))
+        connection.execute("PRAGMA user_version = %d" % (SCHEMA_VERSION + 1))
+        with pytest.raises(SchemaError):
+            migrate(connection)
+        connection.close()
+
+    def it_runs_from_connect(tmp_path):
+        db = SquirrelDB(connect(str(tmp_path / "new.db")))
+        db.createSquirrel("Fluffy", "large")
+        assert db.getSquirrel(1) == {"id": 1, "name": "Fluffy", "size": "large"}
+
+def describe_optimize():
+
+    @pytest.fixture
+    def db(tmp_path):
+        db = SquirrelDB(connect(str(tmp_path / "squirrel_db.db"), rowFactory="tuple"))
+        # Skewed on purpose: nearly every squirrel is large.
+        db.createSquirrels(("Fluffy %d" % (i % 50), "large" if i % 100 else "small") for i in range(20000))
+        yield db
+        db.connection.close()
+
+    def it_keeps_filtered_listings_on_the_indexes(db):
+        optimize(db.connection)
+        assert db.connection.execute("SELECT count(*) FROM sqlite_stat1").fetchone()[0] > 0
+        assert "squirrels_size_id" in query_plan(db.connection, size="small", after=100, limit=50)
+        assert "squirrels_size_id" in query_plan(db.connection, size="large", after=100, limit=50)
+        assert "squirrels_name_id" in query_plan(db.connection, name="Fluffy 7", after=100, limit=50)
+        assert "squirrels_name_id" in query_plan(db.connection, name="Fluffy 7", fields=["name"])
+
+    def it_can_run_on_a_schedule(db, tmp_path):
+        optimizer = Optimizer(str(tmp_path / "squirrel_db.db"), 0.05)
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            if db.connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+                break
+            time.sleep(0.05)
+        optimizer.close()
+        assert db.connection.execute("SELECT count(*) FROM sqlite_stat1").fetchone()[0] > 0
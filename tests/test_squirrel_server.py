@@ -2,13 +2,16 @@ import sys
 import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from squirrel_db import SquirrelDB
+from squirrel_server import negotiateEncoding
 import http.client
 import json
 import pytest
 import shutil
+import socket
 import subprocess
 import time
 import urllib
+import zlib
 import concurrent.futures
 import psutil
 
@@ -21,6 +24,48 @@ def kill_existing_server(port=8080):
                 p.terminate()
                 p.wait()
 
+def start_server_process(port, db, args):
+    server = subprocess.Popen(["python3", "src/squirrel_server.py", "--port", str(port), "--db", db] + args)
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return server
+
+def get_cached(port, path):
+    conn = http.client.HTTPConnection("localhost", port)
+    conn.request("GET", path)
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    return response.getheader("X-Cache"), json.loads(body)
+
+def post_squirrel_to(port, headers, squirrel_data):
+    conn = http.client.HTTPConnection("localhost", port)
+    conn.request("POST", "/squirrels", body=squirrel_data, headers=headers)
+    conn.getresponse().read()
+    conn.close()
+
+def hold_request_slot(port, headers):
+    # Sends a POST's headers but not its body: once admitted, the request
+    # keeps its slot while the server waits for the rest.
+    sock = socket.create_connection(("localhost", port))
+    sock.sendall(b"POST /squirrels HTTP/1.1\r\nHost: localhost\r\nContent-Type: %s\r\nContent-Length: 22\r\n\r\n"
+                 % headers["Content-Type"].encode())
+    time.sleep(0.2)
+    return sock
+
+def status_of(port, path):
+    conn = http.client.HTTPConnection("localhost", port)
+    conn.request("GET", path)
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.status, response.getheader("Retry-After")
+
 DB_PATH = os.path.join(os.path.dirname(__file__), "..", "squirrel_db.db")
 EMPTY_DB_PATH = os.path.join(os.path.dirname(__file__), "..", "empty_squirrel_db.db")
 
@@ -35,9 +80,10 @@ def describe_squirrel_server():
         if os.path.exists(DB_PATH):
             os.remove(DB_PATH)
 
-    @pytest.fixture(scope="session", autouse=True)
-    def start_server():
-        server = subprocess.Popen(["python3", "src/squirrel_server.py"])
+    # Every test below runs once against each serving engine.
+    @pytest.fixture(scope="session", autouse=True, params=["single", "asyncio"])
+    def start_server(request):
+        server = subprocess.Popen(["python3", "src/squirrel_server.py", "--mode", request.param])
         time.sleep(1)
         yield
         kill_existing_server(port=8080)
@@ -70,7 +116,7 @@ def describe_squirrel_server():
 
         def it_can_be_retrieved_after_creation(http_client, headers, squirrel_data):
             http_client.request("POST", "/squirrels", body=squirrel_data, headers=headers)
-            http_client.getresponse()
+            http_client.getresponse().read()
             http_client.request("GET", "/squirrels/1")
             response = http_client.getresponse()
             body = json.loads(response.read())
@@ -117,18 +163,212 @@ def describe_squirrel_server():
 
         def it_returns_array_with_created_squirrel(http_client, headers, squirrel_data):
             http_client.request("POST", "/squirrels", body=squirrel_data, headers=headers)
-            http_client.getresponse()
+            http_client.getresponse().read()
             http_client.request("GET", "/squirrels")
             response = http_client.getresponse()
             body = json.loads(response.read())
             assert any(s["name"] == "Fluffy" and s["size"] == "large" for s in body)
             http_client.close()
 
+    def describe_get_squirrels_with_query():
+
+        @pytest.fixture
+        def four_squirrels(http_client, headers):
+            for name, size in [("Fluffy", "large"), ("Nutty", "small"), ("Fluffy", "small"), ("Bushy", "large")]:
+                data = urllib.parse.urlencode({ "name": name, "size": size })
+                http_client.request("POST", "/squirrels", body=data, headers=headers)
+                http_client.getresponse().read()
+
+        def it_returns_first_page_and_next_cursor(http_client, four_squirrels):
+            http_client.request("GET", "/squirrels?limit=3")
+            response = http_client.getresponse()
+            body = json.loads(response.read())
+            assert [s["id"] for s in body] == [1, 2, 3]
+            assert response.getheader("X-Next-After") == "3"
+            assert "after=3" in response.getheader("Link")
+            http_client.close()
+
+        def it_returns_last_page_without_cursor(http_client, four_squirrels):
+            http_client.request("GET", "/squirrels?limit=3&after=3")
+            response = http_client.getresponse()
+            assert [s["id"] for s in json.loads(response.read())] == [4]
+            assert response.getheader("X-Next-After") is None
+            http_client.close()
+
+        def it_projects_and_filters(http_client, four_squirrels):
+            http_client.request("GET", "/squirrels?fields=name&size=large&limit=1")
+            response = http_client.getresponse()
+            assert json.loads(response.read()) == [{ "name": "Fluffy" }]
+            assert response.getheader("X-Next-After") == "1"
+            http_client.close()
+
+        def it_returns_400_for_bad_parameters(http_client):
+            http_client.request("GET", "/squirrels?limit=abc")
+            assert http_client.getresponse().status == 400
+            http_client.close()
+
+        def it_returns_400_for_unknown_fields(http_client):
+            http_client.request("GET", "/squirrels?fields=color")
+            assert http_client.getresponse().status == 400
+            http_client.close()
+
+    def describe_streamed_listing():
+
+        def it_streams_chunked_json(http_client, headers, squirrel_data):
+            http_client.request("POST", "/squirrels", body=squirrel_data, headers=headers)
+            http_client.getresponse().read()
+            http_client.request("GET", "/squirrels?stream=1")
+            response = http_client.getresponse()
+            assert response.status == 200
+            assert response.getheader("Transfer-Encoding") == "chunked"
+            body = json.loads(response.read())
+            assert body == [{ "id": 1, "name": "Fluffy", "size": "large" }]
+            http_client.close()
+
+        def it_streams_empty_listing(http_client):
+            http_client.request("GET", "/squirrels?stream=1")
+            assert json.loads(http_client.getresponse().read()) == []
+            http_client.close()
+
+        def it_streams_until_close_for_http_10_clients():
+            with socket.create_connection(("localhost", 8080)) as sock:
+                sock.sendall(b"GET /squirrels?stream=1 HTTP/1.0\r\n\r\n")
+                raw = b""
+                while True:
+                    data = sock.recv(65536)
+                    if not data:
+                        break
+                    raw += data
+            head, body = raw.split(b"\r\n\r\n", 1)
+            assert b"chunked" not in head
+            assert json.loads(body) == []
+
+    def describe_bulk():
+
+        def it_creates_squirrels_from_a_json_array(http_client):
+            body = json.dumps([{ "name": "Fluffy", "size": "large" }, { "name": "Nutty", "size": "small" }])
+            http_client.request("POST", "/squirrels/_bulk", body=body, headers={ "Content-Type": "application/json" })
+            response = http_client.getresponse()
+            assert response.status == 200
+            assert json.loads(response.read()) == { "results": [{ "status": 201, "id": 1 }, { "status": 201, "id": 2 }] }
+            http_client.request("GET", "/squirrels")
+            assert [s["name"] for s in json.loads(http_client.getresponse().read())] == ["Fluffy", "Nutty"]
+            http_client.close()
+
+        def it_applies_ndjson_operations_with_per_item_results(http_client):
+            lines = [
+                { "name": "Fluffy", "size": "large" },
+                { "op": "update", "id": 1, "name": "Fluffy", "size": "small" },
+                { "op": "delete", "id": 7 },
+                { "op": "create", "name": "Nameless" },
+                { "op": "delete", "id": 1 },
+            ]
+            body = "\n".join(json.dumps(line) for line in lines) + "\n"
+            http_client.request("POST", "/squirrels/_bulk", body=body, headers={ "Content-Type": "application/x-ndjson" })
+            results = json.loads(http_client.getresponse().read())["results"]
+            assert [r["status"] for r in results] == [201, 204, 404, 400, 204]
+            assert "error" in results[3]
+            http_client.request("GET", "/squirrels")
+            assert json.loads(http_client.getresponse().read()) == []
+            http_client.close()
+
+        def it_returns_400_for_an_unparseable_body(http_client):
+            http_client.request("POST", "/squirrels/_bulk", body="[{", headers={ "Content-Type": "application/json" })
+            response = http_client.getresponse()
+            assert response.status == 400
+            response.read()
+            http_client.request("POST", "/squirrels/_bulk", body="{}", headers={ "Content-Type": "application/json" })
+            response = http_client.getresponse()
+            assert response.status == 400
+            response.read()
+            http_client.close()
+
+    def describe_compression():
+
+        @pytest.fixture
+        def many_squirrels(http_client):
+            body = json.dumps([{ "name": "Squirrel %d" % i, "size": "large" } for i in range(100)])
+            http_client.request("POST", "/squirrels/_bulk", body=body, headers={ "Content-Type": "application/json" })
+            http_client.getresponse().read()
+
+        def it_gzips_large_listings(http_client, many_squirrels):
+            http_client.request("GET", "/squirrels", headers={ "Accept-Encoding": "gzip, deflate" })
+            response = http_client.getresponse()
+            raw = response.read()
+            assert response.getheader("Content-Encoding") == "gzip"
+            assert response.getheader("Vary") == "Accept-Encoding"
+            assert int(response.getheader("Content-Length")) == len(raw)
+            assert len(json.loads(zlib.decompress(raw, 31))) == 100
+            http_client.close()
+
+        def it_honours_q_values(http_client, many_squirrels):
+            http_client.request("GET", "/squirrels", headers={ "Accept-Encoding": "gzip;q=0, deflate" })
+            response = http_client.getresponse()
+            assert response.getheader("Content-Encoding") == "deflate"
+            assert len(json.loads(zlib.decompress(response.read()))) == 100
+            http_client.close()
+
+        def it_leaves_small_bodies_alone(http_client, many_squirrels):
+            http_client.request("GET", "/squirrels/1", headers={ "Accept-Encoding": "gzip" })
+            response = http_client.getresponse()
+            assert response.getheader("Content-Encoding") is None
+            assert json.loads(response.read())["id"] == 1
+            http_client.close()
+
+        def it_sends_identity_without_accept_encoding(http_client, many_squirrels):
+            http_client.request("GET", "/squirrels")
+            response = http_client.getresponse()
+            assert response.getheader("Content-Encoding") is None
+            assert response.getheader("Vary") == "Accept-Encoding"
+            assert len(json.loads(response.read())) == 100
+            http_client.close()
+
+        def it_compresses_streamed_listings_incrementally(http_client, many_squirrels):
+            http_client.request("GET", "/squirrels?stream=1", headers={ "Accept-Encoding": "gzip" })
+            response = http_client.getresponse()
+            assert response.getheader("Content-Encoding") == "gzip"
+            assert response.getheader("Transfer-Encoding") == "chunked"
+            assert len(json.loads(zlib.decompress(response.read(), 31))) == 100
+            http_client.close()
+
+    def describe_metrics():
+
+        def it_exposes_prometheus_metrics(http_client, headers, squirrel_data):
+            http_client.request("POST", "/squirrels", body=squirrel_data, headers=headers)
+            http_client.getresponse().read()
+            http_client.request("GET", "/squirrels/1")
+            http_client.getresponse().read()
+            http_client.request("GET", "/squirrels/42")
+            http_client.getresponse().read()
+            http_client.request("GET", "/_metrics")
+            response = http_client.getresponse()
+            assert response.status == 200
+            assert response.getheader("Content-Type").startswith("text/plain; version=0.0.4")
+            text = response.read().decode("utf-8")
+            assert 'squirrel_http_requests_total{route="/squirrels",method="POST",status="201"}' in text
+            assert 'squirrel_http_requests_total{route="/squirrels/{id}",method="GET",status="404"}' in text
+            assert 'squirrel_http_request_duration_seconds_bucket{route="/squirrels/{id}",le="+Inf"}' in text
+            assert 'squirrel_db_query_duration_seconds_count{method="createSquirrel"}' in text
+            assert "squirrel_http_requests_in_flight 1" in text
+            http_client.close()
+
+        def it_counts_malformed_request_lines(http_client):
+            for line in (b"GARBAGE", b"GET /squirrels HTTP/1.1 extra", b"GET /squirrels HTTP/9.9"):
+                sock = socket.create_connection(("localhost", 8080))
+                sock.sendall(line + b"\r\n\r\n")
+                assert sock.recv(65536)
+                sock.close()
+            http_client.request("GET", "/_metrics")
+            text = http_client.getresponse().read().decode("utf-8")
+            assert "squirrel_http_requests_in_flight 1" in text
+            assert 'squirrel_http_requests_total{route="other",method="-",status="400"} 2' in text
+            http_client.close()
+
     def describe_get_squirrel_by_id():
 
         def it_returns_200_and_correct_body(http_client, headers, squirrel_data):
             http_client.request("POST", "/squirrels", body=squirrel_data, headers=headers)
-            http_client.getresponse()
+            http_client.getresponse().read()
             http_client.request("GET", "/squirrels/1")
             response = http_client.getresponse()
             assert response.status == 200
@@ -145,7 +385,7 @@ def describe_squirrel_server():
             create_data = urllib.parse.urlencode({ "name": "Fluffy", "size": "medium" })
             update_data = urllib.parse.urlencode({ "name": "Fluffier", "size": "giant" })
             http_client.request("POST", "/squirrels", body=create_data, headers=headers)
-            http_client.getresponse()
+            http_client.getresponse().read()
             http_client.request("PUT", "/squirrels/1", body=update_data, headers=headers)
             response = http_client.getresponse()
             assert response.status == 204
@@ -154,9 +394,9 @@ def describe_squirrel_server():
         def it_persists_updated_data(http_client, headers):
             update_data = urllib.parse.urlencode({ "name": "Fluffier", "size": "giant" })
             http_client.request("POST", "/squirrels", body=update_data, headers=headers)
-            http_client.getresponse()
+            http_client.getresponse().read()
             http_client.request("PUT", "/squirrels/1", body=update_data, headers=headers)
-            http_client.getresponse()
+            http_client.getresponse().read()
             http_client.request("GET", "/squirrels/1")
             updated = json.loads(http_client.getresponse().read())
             assert updated["name"] == "Fluffier"
@@ -171,10 +411,10 @@ def describe_squirrel_server():
         
         def it_fully_replaces_record_when_updating_with_new_data(http_client, headers):
             http_client.request("POST", "/squirrels", body=urllib.parse.urlencode({ "name": "Test2", "size": "Test2Size" }), headers=headers)
-            http_client.getresponse()
+            http_client.getresponse().read()
             update_data = urllib.parse.urlencode({ "name": "NewName", "size": "NewSize" })
             http_client.request("PUT", "/squirrels/1", body=update_data, headers=headers)
-            http_client.getresponse()
+            http_client.getresponse().read()
             http_client.request("GET", "/squirrels/1")
             updated = json.loads(http_client.getresponse().read())
             assert updated["name"] == "NewName"
@@ -189,7 +429,7 @@ def describe_squirrel_server():
         def it_ignores_extra_fields_in_put(http_client, headers):
             create_data = urllib.parse.urlencode({ "name": "Fluffy", "size": "medium" })
             http_client.request("POST", "/squirrels", body=create_data, headers=headers)
-            http_client.getresponse()
+            http_client.getresponse().read()
 
             update_data = urllib.parse.urlencode({ "name": "Fluffier", "size": "giant", "color": "gray" })
             http_client.request("PUT", "/squirrels/1", body=update_data, headers=headers)
@@ -200,7 +440,7 @@ def describe_squirrel_server():
         def it_allows_update_with_same_data(http_client, headers):
             data = urllib.parse.urlencode({ "name": "Fluffy", "size": "medium" })
             http_client.request("POST", "/squirrels", body=data, headers=headers)
-            http_client.getresponse()
+            http_client.getresponse().read()
             http_client.request("PUT", "/squirrels/1", body=data, headers=headers)
             response = http_client.getresponse()
             assert response.status == 204
@@ -211,7 +451,7 @@ def describe_squirrel_server():
 
         def it_returns_204_and_deletes_record(http_client, headers, squirrel_data):
             http_client.request("POST", "/squirrels", body=squirrel_data, headers=headers)
-            http_client.getresponse()
+            http_client.getresponse().read()
             http_client.request("DELETE", "/squirrels/1")
             response = http_client.getresponse()
             assert response.status == 204
@@ -238,7 +478,7 @@ def describe_squirrel_server():
         def it_allows_immediate_delete_after_create(http_client, headers):
             data = urllib.parse.urlencode({ "name": "Temp", "size": "small" })
             http_client.request("POST", "/squirrels", body=data, headers=headers)
-            http_client.getresponse()
+            http_client.getresponse().read()
             http_client.request("DELETE", "/squirrels/1")
             response = http_client.getresponse()
             assert response.status == 204
@@ -308,4 +548,336 @@ def describe_squirrel_server():
 
             with concurrent.futures.ThreadPoolExecutor() as executor:
                 results = list(executor.map(lambda _: post_squirrel(), range(10)))
-                assert all(status == 201 for status in results)
\ No newline at end of file
+                assert all(status == 201 for status in results)
+
+    def describe_serving_modes():
+
+        @pytest.fixture(params=[["--mode", "threaded", "--threads", "4"],
+                                ["--mode", "prefork", "--processes", "2", "--threads", "2"],
+                                ["--mode", "threaded", "--threads", "4", "--write-behind", "commit"]])
+        def mode_server(request, tmp_path):
+            db = str(tmp_path / "squirrel_db.db")
+            shutil.copyfile(EMPTY_DB_PATH, db)
+            server = start_server_process(8081, db, request.param)
+            yield server
+            server.terminate()
+            server.wait(timeout=5)
+
+        def it_serves_concurrent_requests(mode_server, headers):
+            def post_squirrel(i):
+                conn = http.client.HTTPConnection("localhost", 8081)
+                data = urllib.parse.urlencode({ "name": "Worker%d" % i, "size": "tiny" })
+                conn.request("POST", "/squirrels", body=data, headers=headers)
+                status = conn.getresponse().status
+                conn.close()
+                return status
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                assert set(executor.map(post_squirrel, range(20))) == {201}
+            conn = http.client.HTTPConnection("localhost", 8081)
+            conn.request("GET", "/squirrels")
+            assert len(json.loads(conn.getresponse().read())) == 20
+            conn.close()
+
+        def it_stops_all_workers_on_terminate(mode_server):
+            mode_server.terminate()
+            mode_server.wait(timeout=5)
+            time.sleep(0.2)
+            with pytest.raises(OSError):
+                socket.create_connection(("localhost", 8081)).close()
+
+        def it_answers_404_when_a_queued_write_finds_the_row_gone(tmp_path, headers, squirrel_data):
+            db = str(tmp_path / "squirrel_db.db")
+            shutil.copyfile(EMPTY_DB_PATH, db)
+            server = start_server_process(8081, db, ["--mode", "threaded", "--threads", "4",
+                                                     "--write-behind", "commit", "--write-batch-delay", "500"])
+            try:
+                post_squirrel_to(8081, headers, squirrel_data)
+
+                def send(method):
+                    conn = http.client.HTTPConnection("localhost", 8081)
+                    conn.request(method, "/squirrels/1", body=squirrel_data, headers=headers)
+                    status = conn.getresponse().status
+                    conn.close()
+                    return status
+
+                # The PUT still sees the row, but is queued behind the DELETE in
+                # the same batch.
+                with concurrent.futures.ThreadPoolExecutor() as executor:
+                    delete = executor.submit(send, "DELETE")
+                    time.sleep(0.1)
+                    put = executor.submit(send, "PUT")
+                    assert (delete.result(), put.result()) == (204, 404)
+            finally:
+                server.terminate()
+                server.wait(timeout=5)
+
+    def describe_content_length():
+
+        def it_is_sent_with_every_status(http_client, headers, squirrel_data):
+            http_client.request("POST", "/squirrels", body=squirrel_data, headers=headers)
+            response = http_client.getresponse()
+            assert (response.status, response.getheader("Content-Length")) == (201, "0")
+            response.read()
+            http_client.request("PUT", "/squirrels/1", body=squirrel_data, headers=headers)
+            response = http_client.getresponse()
+            assert (response.status, response.getheader("Content-Length")) == (204, "0")
+            response.read()
+            http_client.request("GET", "/squirrels/1")
+            response = http_client.getresponse()
+            assert response.getheader("Content-Length") == str(len(response.read()))
+            http_client.request("GET", "/nope")
+            response = http_client.getresponse()
+            assert response.status == 404
+            assert response.getheader("Content-Length") == str(len(response.read()))
+            http_client.close()
+
+    def describe_keep_alive():
+
+        @pytest.fixture(params=["threaded", "asyncio"])
+        def keep_alive_server(request, tmp_path):
+            db = str(tmp_path / "squirrel_db.db")
+            shutil.copyfile(EMPTY_DB_PATH, db)
+            server = start_server_process(8082, db, ["--mode", request.param, "--threads", "4",
+                                                     "--keep-alive-requests", "3", "--keep-alive-timeout", "0.5"])
+            yield server
+            server.terminate()
+            server.wait(timeout=5)
+
+        def it_serves_several_requests_on_one_connection(keep_alive_server, headers, squirrel_data):
+            conn = http.client.HTTPConnection("localhost", 8082)
+            conn.request("POST", "/squirrels", body=squirrel_data, headers=headers)
+            conn.getresponse().read()
+            sock = conn.sock
+            conn.request("POST", "/squirrels/1", body=squirrel_data, headers=headers)
+            response = conn.getresponse()
+            assert response.status == 404
+            response.read()
+            assert conn.sock is sock
+            conn.request("GET", "/squirrels")
+            assert len(json.loads(conn.getresponse().read())) == 1
+            conn.close()
+
+        def it_closes_after_the_request_limit(keep_alive_server):
+            conn = http.client.HTTPConnection("localhost", 8082)
+            for _ in range(2):
+                conn.request("GET", "/squirrels")
+                response = conn.getresponse()
+                response.read()
+                assert response.getheader("Connection") is None
+            conn.request("GET", "/squirrels")
+            response = conn.getresponse()
+            response.read()
+            assert response.getheader("Connection") == "close"
+            conn.close()
+
+        def it_closes_idle_connections(keep_alive_server):
+            with socket.create_connection(("localhost", 8082)) as sock:
+                sock.sendall(b"GET /squirrels HTTP/1.1\r\nHost: localhost\r\n\r\n")
+                response = http.client.HTTPResponse(sock)
+                response.begin()
+                assert (response.status, response.read()) == (200, b"[]")
+                sock.settimeout(5)
+                assert sock.recv(65536) == b""
+
+        def it_closes_after_each_response_in_single_mode(tmp_path):
+            db = str(tmp_path / "squirrel_db.db")
+            shutil.copyfile(EMPTY_DB_PATH, db)
+            server = start_server_process(8082, db, ["--mode", "single"])
+            try:
+                conn = http.client.HTTPConnection("localhost", 8082)
+                conn.request("GET", "/squirrels")
+                response = conn.getresponse()
+                response.read()
+                assert response.getheader("Connection") == "close"
+                conn.close()
+            finally:
+                server.terminate()
+                server.wait(timeout=5)
+
+    def describe_response_cache():
+
+        @pytest.fixture
+        def cache_db(tmp_path):
+            db = str(tmp_path / "squirrel_db.db")
+            shutil.copyfile(EMPTY_DB_PATH, db)
+            return db
+
+        def it_serves_repeated_reads_from_the_cache(cache_db, headers, squirrel_data):
+            server = start_server_process(8083, cache_db, ["--response-cache", "local"])
+            try:
+                post_squirrel_to(8083, headers, squirrel_data)
+                assert get_cached(8083, "/squirrels") == ("MISS", [{ "id": 1, "name": "Fluffy", "size": "large" }])
+                assert get_cached(8083, "/squirrels")[0] == "HIT"
+                assert get_cached(8083, "/squirrels/1")[0] == "MISS"
+                assert get_cached(8083, "/squirrels/1")[0] == "HIT"
+                post_squirrel_to(8083, headers, squirrel_data)
+                cacheStatus, squirrels = get_cached(8083, "/squirrels")
+                assert (cacheStatus, len(squirrels)) == ("MISS", 2)
+                assert get_cached(8083, "/squirrels/1")[0] == "HIT"
+            finally:
+                server.terminate()
+                server.wait(timeout=5)
+
+        def it_does_not_serve_other_spellings_of_a_cached_id(cache_db, headers, squirrel_data):
+            server = start_server_process(8083, cache_db, ["--response-cache", "local"])
+            try:
+                for _ in range(10):
+                    post_squirrel_to(8083, headers, squirrel_data)
+                assert get_cached(8083, "/squirrels/10")[0] == "MISS"
+                assert get_cached(8083, "/squirrels/10")[0] == "HIT"
+                assert status_of(8083, "/squirrels/1_0")[0] == 404
+            finally:
+                server.terminate()
+                server.wait(timeout=5)
+
+        @pytest.mark.parametrize("args", [[], ["--mode", "threaded", "--write-behind", "commit"]])
+        def it_invalidates_writes_through_other_spellings_of_an_id(cache_db, headers, squirrel_data, args):
+            server = start_server_process(8083, cache_db, ["--response-cache", "local"] + args)
+            try:
+                post_squirrel_to(8083, headers, squirrel_data)
+                post_squirrel_to(8083, headers, squirrel_data)
+                assert get_cached(8083, "/squirrels/1")[0] == "MISS"
+                assert get_cached(8083, "/squirrels/1")[0] == "HIT"
+                conn = http.client.HTTPConnection("localhost", 8083)
+                conn.request("PUT", "/squirrels/1.0", body="name=Changed&size=small", headers=headers)
+                assert conn.getresponse().status == 204
+                conn.close()
+                assert get_cached(8083, "/squirrels/1") == ("MISS", { "id": 1, "name": "Changed", "size": "small" })
+                assert get_cached(8083, "/squirrels/2")[0] == "MISS"
+                conn = http.client.HTTPConnection("localhost", 8083)
+                conn.request("DELETE", "/squirrels/2e0")
+                assert conn.getresponse().status == 204
+                conn.close()
+                assert status_of(8083, "/squirrels/2")[0] == 404
+            finally:
+                server.terminate()
+                server.wait(timeout=5)
+
+        def it_caches_compressed_responses(cache_db, headers, squirrel_data):
+            server = start_server_process(8083, cache_db, ["--response-cache", "local", "--compress-min-bytes", "0"])
+            try:
+                post_squirrel_to(8083, headers, squirrel_data)
+                for expected in ("MISS", "HIT"):
+                    conn = http.client.HTTPConnection("localhost", 8083)
+                    conn.request("GET", "/squirrels", headers={ "Accept-Encoding": "gzip" })
+                    response = conn.getresponse()
+                    assert response.getheader("X-Cache") == expected
+                    assert response.getheader("Content-Encoding") == "gzip"
+                    assert json.loads(zlib.decompress(response.read(), 31))[0]["name"] == "Fluffy"
+                    conn.close()
+                assert get_cached(8083, "/squirrels")[0] == "HIT"
+            finally:
+                server.terminate()
+                server.wait(timeout=5)
+
+        def it_counts_one_hit_or_miss_per_request(cache_db, headers, squirrel_data):
+            server = start_server_process(8083, cache_db, ["--response-cache", "local", "--compress-min-bytes", "0"])
+            try:
+                post_squirrel_to(8083, headers, squirrel_data)
+                for _ in range(5):
+                    conn = http.client.HTTPConnection("localhost", 8083)
+                    conn.request("GET", "/squirrels", headers={ "Accept-Encoding": "gzip" })
+                    conn.getresponse().read()
+                    conn.close()
+                conn = http.client.HTTPConnection("localhost", 8083)
+                conn.request("GET", "/_metrics")
+                text = conn.getresponse().read().decode()
+                conn.close()
+                assert "squirrel_response_cache_hits_total 4\n" in text
+                assert "squirrel_response_cache_misses_total 1\n" in text
+            finally:
+                server.terminate()
+                server.wait(timeout=5)
+
+        def it_sees_writes_from_other_processes_in_shared_mode(cache_db, headers, squirrel_data):
+            servers = [start_server_process(port, cache_db, ["--response-cache", "shared"]) for port in (8083, 8084)]
+            try:
+                assert get_cached(8083, "/squirrels") == ("MISS", [])
+                assert get_cached(8083, "/squirrels") == ("HIT", [])
+                post_squirrel_to(8084, headers, squirrel_data)
+                assert get_cached(8083, "/squirrels") == ("MISS", [{ "id": 1, "name": "Fluffy", "size": "large" }])
+            finally:
+                for server in servers:
+                    server.terminate()
+                    server.wait(timeout=5)
+
+    def describe_admission_control():
+
+        @pytest.fixture
+        def admission_server(tmp_path):
+            db = str(tmp_path / "squirrel_db.db")
+            shutil.copyfile(EMPTY_DB_PATH, db)
+            servers = []
+
+            def start(mode, *args):
+                servers.append(start_server_process(8085, db, ["--mode", mode, "--threads", "4"] + list(args)))
+            yield start
+            for server in servers:
+                server.terminate()
+                server.wait(timeout=5)
+
+        # The asyncio engine reads a request's body before handing it to a
+        # worker, so hold_request_slot only holds a slot in threaded mode.
+        def it_answers_503_when_saturated(admission_server, headers):
+            admission_server("threaded", "--max-in-flight", "1", "--max-queue", "0", "--retry-after", "7")
+            sock = hold_request_slot(8085, headers)
+            assert status_of(8085, "/squirrels") == (503, "7")
+            assert status_of(8085, "/_metrics")[0] == 200
+            sock.sendall(b"name=Fluffy&size=large")
+            assert sock.recv(65536).startswith(b"HTTP/1.1 201")
+            sock.close()
+            # The slot is handed back just after the response goes out.
+            time.sleep(0.2)
+            assert status_of(8085, "/squirrels") == (200, None)
+
+        def it_queues_until_a_slot_frees_up(admission_server, headers):
+            admission_server("threaded", "--max-in-flight", "1", "--max-queue", "1", "--queue-timeout", "5")
+            sock = hold_request_slot(8085, headers)
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                waiting = executor.submit(status_of, 8085, "/squirrels")
+                time.sleep(0.3)
+                assert not waiting.done()
+                sock.sendall(b"name=Fluffy&size=large")
+                assert waiting.result(timeout=5) == (200, None)
+            sock.close()
+
+        @pytest.mark.parametrize("mode", ["threaded", "asyncio"])
+        def it_answers_rejected_requests_with_large_bodies(admission_server, headers, mode):
+            admission_server(mode, "--rate-limit", "0.01", "--rate-burst", "1")
+            body = "name=%s&size=large" % ("x" * 2 * 1024 * 1024)
+            results = []
+            for _ in range(3):
+                conn = http.client.HTTPConnection("localhost", 8085)
+                conn.request("POST", "/squirrels", body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                results.append((response.status, response.getheader("Retry-After")))
+                conn.close()
+            assert results[0][0] == 201
+            assert [status for status, _ in results[1:]] == [429, 429]
+            assert all(retryAfter for _, retryAfter in results[1:])
+
+        @pytest.mark.parametrize("mode", ["threaded", "asyncio"])
+        def it_rate_limits_each_client(admission_server, mode):
+            admission_server(mode, "--rate-limit", "0.5", "--rate-burst", "2")
+            assert [status_of(8085, "/squirrels") for _ in range(3)] == [(200, None), (200, None), (429, "2")]
+            assert status_of(8085, "/_metrics")[0] == 200
+
+def describe_negotiateEncoding():
+
+    def it_prefers_gzip():
+        assert negotiateEncoding("deflate, gzip") == "gzip"
+
+    def it_follows_q_values():
+        assert negotiateEncoding("gzip;q=0.5, deflate;q=0.8") == "deflate"
+        assert negotiateEncoding("gzip;q=0") is None
+
+    def it_accepts_wildcards():
+        assert negotiateEncoding("*") == "gzip"
+        assert negotiateEncoding("gzip;q=0, *;q=0.1") == "deflate"
+
+    def it_returns_none_for_identity():
+        assert negotiateEncoding("identity") is None
+        assert negotiateEncoding(None) is None
+